@@ -1,7 +1,28 @@
+import array
+import atexit
+import calendar
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
 import time
+import uuid
 from ast import literal_eval
+from collections import OrderedDict
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from io import BytesIO
 from ansible.module_utils.six import iteritems
 from ansible.module_utils.six import get_function_code
+from ansible.module_utils.six import reraise
+from ansible.module_utils.six import string_types
 
 try:
     import boto.ec2
@@ -16,7 +37,8 @@ except ImportError:
 def find_running_instances_by_count_tag(module, ec2, count_tag, zone=None):
 
     # get reservations for instances that match tag(s) and are running
-    reservations = get_reservations(module, ec2, tags=count_tag, state="running", zone=zone)
+    reservations = get_reservations(module, ec2, tags=count_tag, state="running", zone=zone,
+                                    query=module.params.get('instance_filter'))
 
     instances = []
     for res in reservations:
@@ -27,6 +49,237 @@ def find_running_instances_by_count_tag(module, ec2, count_tag, zone=None):
     return reservations, instances
 
 
+def _write_json_atomic(path, data):
+    # write to a temporary file in the same directory and rename it over
+    # path, so readers never see a partially written file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ec2-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+def _parallel_map(func, items, workers):
+    """
+    Calls func on every item using up to workers threads
+    Returns:
+        list of results in the same order as items
+    The first exception raised by func (including the SystemExit raised by
+    module.fail_json) is re-raised in the calling thread once all the
+    threads have finished.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                index, item = pending.pop(0)
+            try:
+                results[index] = func(item)
+            except BaseException:
+                with lock:
+                    errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        reraise(*errors[0])
+    return results
+
+
+# Connection methods ec2.py calls, directly or through boto instance and
+# spot request objects, which call back into the connection that
+# described them (inst.get_attribute calls get_instance_attribute, and so on)
+PROFILED_CALLS = ('get_all_instances', 'get_all_reservations', 'run_instances', 'terminate_instances',
+                  'start_instances', 'stop_instances', 'reboot_instances', 'create_tags',
+                  'get_instance_attribute', 'modify_instance_attribute', 'get_all_instance_status',
+                  'get_all_network_interfaces', 'modify_network_interface_attribute',
+                  'request_spot_instances', 'get_all_spot_instance_requests', 'cancel_spot_instance_requests',
+                  'get_all_security_groups', 'get_all_snapshots', 'get_all_zones', 'get_all_subnets')
+
+_call_hooks = []
+_call_state = threading.local()
+# called with a message when a hook fails, set by enable_call_profiling
+_call_hook_warn = [None]
+
+
+def register_call_hook(pre=None, post=None):
+    """
+    Registers callbacks run around every profiled connection call
+    pre: called as pre(action, params_size) before the call
+    post: called as post(action, params_size, duration, error_code) after
+      the call, with error_code None when it succeeded
+    """
+    _call_hooks.append((pre, post))
+
+
+def _run_call_hook(hook, *args):
+    # profiling must never change the outcome of the call it measures, so
+    # a failing hook is only reported
+    try:
+        hook(*args)
+    except Exception as e:
+        if _call_hook_warn[0]:
+            _call_hook_warn[0]('Call profiling hook failed for {0}: {1}'.format(args[0], e))
+
+
+def _profiled(action, method):
+    def call(*args, **kwargs):
+        # only the outermost call is reported, as get_all_instances goes
+        # through get_all_reservations
+        if getattr(_call_state, 'active', False):
+            return method(*args, **kwargs)
+        params_size = len(repr((args, kwargs)))
+        for (pre, post) in _call_hooks:
+            if pre:
+                _run_call_hook(pre, action, params_size)
+        error_code = None
+        _call_state.active = True
+        started = time.time()
+        try:
+            return method(*args, **kwargs)
+        except boto.exception.BotoServerError as e:
+            error_code = e.error_code
+            raise
+        except Exception as e:
+            error_code = e.__class__.__name__
+            raise
+        finally:
+            duration = time.time() - started
+            _call_state.active = False
+            for (pre, post) in _call_hooks:
+                if post:
+                    _run_call_hook(post, action, params_size, duration, error_code)
+    return call
+
+
+def instrument_connection(conn):
+    """
+    Wraps the PROFILED_CALLS methods of a boto connection so that they run
+    the registered call hooks
+    Returns:
+        the connection
+    """
+    for action in PROFILED_CALLS:
+        method = getattr(conn, action, None)
+        if method is not None:
+            setattr(conn, action, _profiled(action, method))
+    return conn
+
+
+class SlowCallLog(object):
+    """
+    Call hook appending the calls that took at least threshold seconds to
+    path, one JSON record per line
+    """
+
+    def __init__(self, path, threshold):
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+
+    def __call__(self, action, params_size, duration, error_code):
+        if duration < self.threshold:
+            return
+        record = {'time': time.time(), 'action': action, 'params_size': params_size,
+                  'duration': round(duration, 6), 'error_code': error_code}
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True))
+                f.write('\n')
+
+
+class LatencyHistogram(object):
+    """
+    Call hook recording the latency of every call per action
+    """
+
+    # upper bounds, in seconds, of the histogram buckets
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.durations = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, action, params_size, duration, error_code):
+        with self.lock:
+            self.durations.setdefault(action, []).append(duration)
+            if error_code:
+                self.errors[action] = self.errors.get(action, 0) + 1
+
+    def summary(self):
+        """
+        Returns, per action, the call and error counts, total time,
+        p50/p95/p99/max latencies and the number of calls per bucket
+        """
+        def percentile(durations, p):
+            return durations[max(int(math.ceil(p / 100.0 * len(durations))) - 1, 0)]
+
+        result = {}
+        with self.lock:
+            for action, durations in iteritems(self.durations):
+                durations = sorted(durations)
+                buckets = OrderedDict()
+                for bound in self.BUCKETS:
+                    buckets['le_%s' % bound] = len([d for d in durations if d <= bound])
+                buckets['le_inf'] = len(durations)
+                result[action] = {'count': len(durations),
+                                  'errors': self.errors.get(action, 0),
+                                  'total': round(sum(durations), 6),
+                                  'p50': round(percentile(durations, 50), 6),
+                                  'p95': round(percentile(durations, 95), 6),
+                                  'p99': round(percentile(durations, 99), 6),
+                                  'max': round(durations[-1], 6),
+                                  'buckets': buckets,
+                                  }
+        return result
+
+    def write(self, path):
+        _write_json_atomic(path, self.summary())
+
+    def write_at_exit(self, path):
+        # the module result has already been printed when this runs, so a
+        # failure can only be reported on stderr
+        try:
+            self.write(path)
+        except Exception as e:
+            sys.stderr.write('Unable to write call profile to {0}: {1}\n'.format(path, e))
+
+
+def enable_call_profiling(module, *connections):
+    """
+    Instruments connections according to slow_call_log, slow_call_threshold
+    and call_profile_path. The latency profile is written when the module
+    exits, including through fail_json.
+    """
+    slow_call_log = module.params.get('slow_call_log')
+    call_profile_path = module.params.get('call_profile_path')
+    _call_hook_warn[0] = module.warn
+
+    if slow_call_log:
+        register_call_hook(post=SlowCallLog(slow_call_log, module.params.get('slow_call_threshold')))
+    if call_profile_path:
+        histogram = LatencyHistogram()
+        register_call_hook(post=histogram)
+        atexit.register(histogram.write_at_exit, call_profile_path)
+
+    for conn in connections:
+        if conn is not None:
+            instrument_connection(conn)
+
+
 def _set_none_to_blank(dictionary):
     result = dictionary
     for k in result:
@@ -37,10 +290,65 @@ def _set_none_to_blank(dictionary):
     return result
 
 
-def get_reservations(module, ec2, tags=None, state=None, zone=None):
+def describe_instances(module, ec2, instance_ids=None, filters=None):
+    """
+    Returns the reservations matching instance_ids and filters. When
+    describe_shard_by names a filter (availability-zone, instance-state-name
+    or instance-type), the query is split into one describe call per value
+    of that filter, fetched concurrently by up to max_concurrency workers,
+    and the results are merged without duplicate instances. The values are
+    taken from describe_shards, or default to every zone of the region or
+    every instance state.
+    """
+    filters = filters or {}
+    shard_by = module.params.get('describe_shard_by')
+
+    # a list of instance IDs or a filter on the shard key already narrows
+    # the query down to a single shard
+    if not shard_by or instance_ids or shard_by in filters:
+        return ec2.get_all_instances(instance_ids, filters=filters)
+
+    shards = module.params.get('describe_shards')
+    if not shards:
+        if shard_by == 'availability-zone':
+            shards = [zone.name for zone in ec2.get_all_zones()]
+        elif shard_by == 'instance-state-name':
+            shards = list(INSTANCE_STATE_CODES)
+        else:
+            module.fail_json(msg='describe_shards must list the values to shard on for %s' % shard_by)
+
+    def describe(shard):
+        shard_filters = dict(filters)
+        shard_filters[shard_by] = shard
+        return ec2.get_all_instances(filters=shard_filters)
+
+    reservations = OrderedDict()
+    seen = set()
+    for shard_reservations in _parallel_map(describe, shards, module.params.get('max_concurrency')):
+        for res in shard_reservations:
+            # a reservation spanning several shards is returned once per
+            # shard, holding only the instances of that shard
+            merged = reservations.setdefault(res.id, res)
+            new_instances = [inst for inst in res.instances if inst.id not in seen]
+            seen.update(inst.id for inst in new_instances)
+            if merged is res:
+                res.instances = new_instances
+            else:
+                merged.instances.extend(new_instances)
+    return list(reservations.values())
+
+
+def get_reservations(module, ec2, tags=None, state=None, zone=None, query=None):
+    """
+    Returns the reservations of instances matching tags, state and zone,
+    restricted to those matching query (see InventorySnapshot.select).
+    Tags that can not be expressed as server side filters, such as the
+    same tag required with two different values, or tag names with
+    underscores, are matched locally.
+    """
 
-    # TODO: filters do not work with tags that have underscores
     filters = dict()
+    match_locally = False
 
     if tags is not None:
 
@@ -50,23 +358,34 @@ def get_reservations(module, ec2, tags=None, state=None, zone=None):
             except:
                 pass
 
+        tag_filters = []
+
         # if string, we only care that a tag of that name exists
         if isinstance(tags, str):
-            filters.update({"tag-key": tags})
+            tag_filters.append(("tag-key", tags))
 
         # if list, append each item to filters
         if isinstance(tags, list):
             for x in tags:
                 if isinstance(x, dict):
                     x = _set_none_to_blank(x)
-                    filters.update(dict(("tag:"+tn, tv) for (tn,tv) in iteritems(x)))
+                    tag_filters.extend(("tag:"+tn, tv) for (tn,tv) in iteritems(x))
                 else:
-                    filters.update({"tag-key": x})
+                    tag_filters.append(("tag-key", x))
 
         # if dict, add the key and value to the filter
         if isinstance(tags, dict):
             tags = _set_none_to_blank(tags)
-            filters.update(dict(("tag:"+tn, tv) for (tn,tv) in iteritems(tags)))
+            tag_filters.extend(("tag:"+tn, tv) for (tn,tv) in iteritems(tags))
+
+        for (name, value) in tag_filters:
+            if '_' in name or (name in filters and filters[name] != value):
+                match_locally = True
+            else:
+                filters[name] = value
+        if match_locally:
+            # keep only the filters that can not exclude a matching instance
+            filters = dict((name, value) for (name, value) in iteritems(filters) if '_' not in name)
 
     if state:
         # http://stackoverflow.com/questions/437511/what-are-the-valid-instancestates-for-the-amazon-ec2-api
@@ -75,10 +394,513 @@ def get_reservations(module, ec2, tags=None, state=None, zone=None):
     if zone:
         filters.update({'availability-zone': zone})
 
-    results = ec2.get_all_instances(filters=filters)
+    results = describe_instances(module, ec2, filters=filters)
+
+    local_query = []
+    if match_locally:
+        local_query.extend(tags_to_query(tags))
+    if query:
+        local_query.append(query)
+    results = filter_reservations(results, local_query)
+
+    snapshot_path = module.params.get('inventory_snapshot_path')
+    if snapshot_path and not module.params.get('plan_from_snapshot'):
+        instances = []
+        for res in results:
+            instances.extend(res.instances)
+        try:
+            InventorySnapshot.from_instances(instances).write(
+                snapshot_path, source=snapshot_source(tags, state, zone, query))
+        except (IOError, OSError) as e:
+            module.fail_json(msg='Unable to write inventory snapshot {0}, error: {1}'.format(snapshot_path, e))
 
     return results
 
+def snapshot_source(tags, state, zone, query):
+    """
+    Describes the filters an inventory snapshot was taken with, in a form
+    that compares equal for equivalent tags
+    """
+    return json.loads(json.dumps({'tags': tags_to_query(tags), 'state': state,
+                                  'zone': zone, 'query': query}, sort_keys=True))
+
+# instance-state-name to instance state code, as reported by DescribeInstances
+INSTANCE_STATE_CODES = {'pending': 0, 'running': 16, 'shutting-down': 32,
+                        'terminated': 48, 'stopping': 64, 'stopped': 80}
+
+
+def _launch_time_to_epoch(value):
+    """
+    Converts an EC2 launch_time such as 2016-08-01T12:00:00.000Z, or a
+    number of seconds since the epoch, to seconds since the epoch
+    """
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    return float(calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')))
+
+
+def _encode_column(values):
+    """
+    Dictionary encodes a column of strings
+    Returns:
+        (array of codes, list of distinct values indexed by code)
+    Code 0 is reserved for missing values. Columns with fewer than 256
+    distinct values are stored one byte per row, which lets predicates
+    select them with bytes.translate instead of a Python loop.
+    """
+    table = [None]
+    codes = {}
+    encoded = []
+    for value in values:
+        if value is None:
+            encoded.append(0)
+            continue
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(table)
+            table.append(value)
+        encoded.append(code)
+    return array.array('B' if len(table) <= 256 else 'I', encoded), table
+
+
+class InventorySnapshot(object):
+    """
+    Columnar snapshot of instances used to select instances locally.
+    Every predicate evaluates to a bitmask with bit i set when row i
+    matches, so and/or/not combine whole columns in a single integer
+    operation.
+    """
+
+    def __init__(self, ids, state_codes, zones, instance_types, launch_times, tags, instances=None,
+                 created=None, source=None):
+        self.ids = ids
+        self.state_codes = state_codes
+        self.zones = zones
+        self.instance_types = instance_types
+        self.launch_times = launch_times
+        self.tags = tags
+        self.instances = instances
+        self.created = time.time() if created is None else created
+        self.source = source
+        self.all_rows = (1 << len(ids)) - 1
+
+    @classmethod
+    def from_instances(cls, instances):
+        instances = list(instances)
+        tag_keys = set()
+        for inst in instances:
+            tag_keys.update(inst.tags or {})
+        return cls(ids=[inst.id for inst in instances],
+                   state_codes=array.array('B', [INSTANCE_STATE_CODES.get(inst.state, 255) for inst in instances]),
+                   zones=_encode_column([inst.placement for inst in instances]),
+                   instance_types=_encode_column([inst.instance_type for inst in instances]),
+                   launch_times=array.array('d', [_launch_time_to_epoch(inst.launch_time) for inst in instances]),
+                   tags=dict((key, _encode_column([(inst.tags or {}).get(key) for inst in instances]))
+                             for key in tag_keys),
+                   instances=instances)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _mask(self, column, codes):
+        if not codes:
+            return 0
+        # arrays have a typecode, memory-mapped columns a format
+        if getattr(column, 'typecode', None) == 'B' or getattr(column, 'format', None) == 'B':
+            table = bytearray(b'0' * 256)
+            for code in codes:
+                table[code] = ord('1')
+            bits = column.tostring() if not hasattr(column, 'tobytes') else column.tobytes()
+            return int(bits.translate(bytes(table))[::-1] or b'0', 2)
+        return int(''.join('1' if code in codes else '0' for code in reversed(column)) or '0', 2)
+
+    def _match_encoded(self, encoded, condition):
+        column, table = encoded
+        if isinstance(condition, dict):
+            if condition.get('exists') is False:
+                return self._mask(column, set([0]))
+            codes = set(range(1, len(table)))
+            for op, value in iteritems(condition):
+                if op == 'exists':
+                    continue
+                elif op == 'in':
+                    codes &= set(code for code in range(1, len(table)) if table[code] in value)
+                elif op == 'prefix':
+                    codes &= set(code for code in range(1, len(table)) if table[code].startswith(value))
+                elif op == 'regex':
+                    pattern = re.compile(value)
+                    codes &= set(code for code in range(1, len(table)) if pattern.search(table[code]))
+                else:
+                    raise ValueError('unknown operator %s' % op)
+        elif isinstance(condition, list):
+            codes = set(code for code in range(1, len(table)) if table[code] in condition)
+        else:
+            codes = set(code for code in range(1, len(table)) if table[code] == condition)
+        return self._mask(column, codes)
+
+    def _match_field(self, field, condition):
+        if field.startswith('tag:'):
+            encoded = self.tags.get(field[4:])
+            if encoded is None:
+                absent = isinstance(condition, dict) and condition.get('exists') is False
+                return self.all_rows if absent else 0
+            return self._match_encoded(encoded, condition)
+        if field == 'zone':
+            return self._match_encoded(self.zones, condition)
+        if field == 'instance_type':
+            return self._match_encoded(self.instance_types, condition)
+        if field == 'state':
+            states = condition if isinstance(condition, list) else [condition]
+            return self._mask(self.state_codes, set(INSTANCE_STATE_CODES[s] for s in states))
+        if field == 'launch_time':
+            before = _launch_time_to_epoch(condition.get('before', float('inf')))
+            after = _launch_time_to_epoch(condition.get('after', float('-inf')))
+            return int(''.join('1' if after <= t < before else '0' for t in reversed(self.launch_times)) or '0', 2)
+        raise ValueError('unknown field %s' % field)
+
+    def select(self, query):
+        """
+        Returns the bitmask of the rows matching query. A query is either
+        a list of queries that must all match, a dict with a single 'and',
+        'or' or 'not' key, or a dict mapping fields to conditions that must
+        all match. Fields are 'state', 'zone', 'instance_type',
+        'launch_time' and 'tag:<key>'. A condition is a value, a list of
+        accepted values, or a dict of operators: exists, in, prefix, regex
+        (and before/after for launch_time).
+        """
+        if query is None:
+            return self.all_rows
+        if isinstance(query, list):
+            mask = self.all_rows
+            for sub_query in query:
+                mask &= self.select(sub_query)
+            return mask
+        if 'and' in query:
+            return self.select(list(query['and']))
+        if 'or' in query:
+            mask = 0
+            for sub_query in query['or']:
+                mask |= self.select(sub_query)
+            return mask
+        if 'not' in query:
+            return self.all_rows & ~self.select(query['not'])
+        mask = self.all_rows
+        for field, condition in iteritems(query):
+            mask &= self._match_field(field, condition)
+        return mask
+
+    def rows(self, mask):
+        bits = bin(mask)[2:][::-1]
+        return [index for index, bit in enumerate(bits) if bit == '1']
+
+    def filter(self, query):
+        """
+        Returns the instances of this snapshot that match query
+        """
+        return [self.instances[index] for index in self.rows(self.select(query))]
+
+    def ids_matching(self, query):
+        """
+        Returns the IDs of the instances that match query, which unlike
+        filter also works on snapshots opened from a file
+        """
+        return [self.ids[index] for index in self.rows(self.select(query))]
+
+    def write(self, path, source=None):
+        """
+        Saves the snapshot in the binary format read by open, along with
+        its creation time and source, the filters its instances were
+        selected with (see snapshot_source)
+        """
+        if source is not None:
+            self.source = source
+        _write_inventory_snapshot(path, self)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-maps a snapshot saved by write. Only the header, the tag
+        keys and the distinct values of each column are decoded; the
+        columns themselves are read in place from the mapping.
+        """
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return _read_inventory_snapshot(buf)
+
+
+# Binary inventory snapshot layout, little-endian, each section aligned to
+# 8 bytes:
+#   header        magic, version, rows, tag keys, strings, strings offset,
+#                 creation time (float64), string index of the JSON source
+#   ids           rows x 20 bytes, NUL padded
+#   state codes   rows x uint8
+#   launch times  rows x float64, seconds since the epoch
+#   zones, instance types, then for each tag key: uint32 key string
+#   followed by an encoded column:
+#                 uint32 number of distinct values, uint8 code width,
+#                 uint32 string index of each distinct value,
+#                 rows x code (1 or 4 bytes)
+#   strings       (strings + 1) x uint32 offsets, then the UTF-8 blob
+INVENTORY_SNAPSHOT_MAGIC = b'EC2INVSN'
+INVENTORY_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct('<8sIIIIQdI4x')
+_SNAPSHOT_COLUMN_HEADER = struct.Struct('<IB3x')
+INSTANCE_ID_WIDTH = 20
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _column_bytes(column):
+    return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+
+def _column_view(buf, offset, typecode, count):
+    """
+    Returns count items of typecode at offset of buf without copying them
+    where the Python version allows it
+    """
+    view = memoryview(buf)[offset:offset + struct.calcsize(typecode) * count]
+    try:
+        return view.cast(typecode)
+    except AttributeError:
+        # Python 2 memoryviews can not be cast, so copy the column
+        column = array.array(typecode)
+        column.fromstring(view.tobytes())
+        return column
+
+
+class _FixedWidthStrings(object):
+    """
+    Read-only sequence of NUL padded strings stored at a fixed width
+    """
+
+    def __init__(self, buf, offset, width, count):
+        self.buf = buf
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start = self.offset + index * self.width
+        return self.buf[start:start + self.width].rstrip(b'\0').decode('ascii')
+
+
+def _write_inventory_snapshot(path, snapshot):
+    strings = [u'']
+    string_index = {u'': 0}
+
+    def intern(value):
+        if value not in string_index:
+            string_index[value] = len(strings)
+            strings.append(value)
+        return string_index[value]
+
+    def pad(chunks, size):
+        chunks.append(b'\0' * (_align(size) - size))
+        return _align(size)
+
+    source_index = intern(json.dumps(snapshot.source, sort_keys=True))
+    rows = len(snapshot)
+    chunks = []
+    size = _SNAPSHOT_HEADER.size
+
+    chunks.append(b''.join(inst_id.encode('ascii').ljust(INSTANCE_ID_WIDTH, b'\0') for inst_id in snapshot.ids))
+    size = pad(chunks, size + rows * INSTANCE_ID_WIDTH)
+    chunks.append(_column_bytes(snapshot.state_codes))
+    size = pad(chunks, size + rows)
+    chunks.append(struct.pack('<%dd' % rows, *snapshot.launch_times))
+    size = pad(chunks, size + rows * 8)
+
+    def encoded_column(encoded):
+        codes, table = encoded
+        width = 1 if len(table) <= 256 else 4
+        table_ids = [0] + [intern(value) for value in list(table)[1:]]
+        chunks.append(_SNAPSHOT_COLUMN_HEADER.pack(len(table_ids), width))
+        chunks.append(struct.pack('<%dI' % len(table_ids), *table_ids))
+        column_size = pad(chunks, size + _SNAPSHOT_COLUMN_HEADER.size + 4 * len(table_ids))
+        chunks.append(struct.pack('<%d%s' % (rows, 'B' if width == 1 else 'I'), *codes))
+        return pad(chunks, column_size + rows * width)
+
+    size = encoded_column(snapshot.zones)
+    size = encoded_column(snapshot.instance_types)
+    for key in sorted(snapshot.tags):
+        chunks.append(struct.pack('<I4x', intern(key)))
+        size += 8
+        size = encoded_column(snapshot.tags[key])
+
+    strings_offset = size
+    blobs = [value.encode('utf-8') for value in strings]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    chunks.append(struct.pack('<%dI' % len(offsets), *offsets))
+    chunks.extend(blobs)
+
+    header = _SNAPSHOT_HEADER.pack(INVENTORY_SNAPSHOT_MAGIC, INVENTORY_SNAPSHOT_VERSION,
+                                   rows, len(snapshot.tags), len(strings), strings_offset,
+                                   snapshot.created, source_index)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ec2-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+    os.rename(tmp_path, path)
+
+
+def _read_inventory_snapshot(buf):
+    if len(buf) < _SNAPSHOT_HEADER.size:
+        raise ValueError('not an inventory snapshot of version %d' % INVENTORY_SNAPSHOT_VERSION)
+    (magic, version, rows, tag_keys, string_count, strings_offset,
+     created, source_index) = _SNAPSHOT_HEADER.unpack_from(buf, 0)
+    if magic != INVENTORY_SNAPSHOT_MAGIC or version != INVENTORY_SNAPSHOT_VERSION:
+        raise ValueError('not an inventory snapshot of version %d' % INVENTORY_SNAPSHOT_VERSION)
+
+    string_offsets = _column_view(buf, strings_offset, 'I', string_count + 1)
+    blob_offset = strings_offset + 4 * (string_count + 1)
+
+    def string(index):
+        return buf[blob_offset + string_offsets[index]:blob_offset + string_offsets[index + 1]].decode('utf-8')
+
+    offset = _SNAPSHOT_HEADER.size
+    ids = _FixedWidthStrings(buf, offset, INSTANCE_ID_WIDTH, rows)
+    offset = _align(offset + rows * INSTANCE_ID_WIDTH)
+    state_codes = _column_view(buf, offset, 'B', rows)
+    offset = _align(offset + rows)
+    launch_times = _column_view(buf, offset, 'd', rows)
+    offset = _align(offset + rows * 8)
+
+    def encoded_column(offset):
+        (table_size, width) = _SNAPSHOT_COLUMN_HEADER.unpack_from(buf, offset)
+        offset += _SNAPSHOT_COLUMN_HEADER.size
+        table = [None] + [string(index) for index in struct.unpack_from('<%dI' % table_size, buf, offset)[1:]]
+        offset = _align(offset + 4 * table_size)
+        codes = _column_view(buf, offset, 'B' if width == 1 else 'I', rows)
+        return (codes, table), _align(offset + rows * width)
+
+    zones, offset = encoded_column(offset)
+    instance_types, offset = encoded_column(offset)
+    tags = {}
+    for i in range(tag_keys):
+        key = string(struct.unpack_from('<I', buf, offset)[0])
+        tags[key], offset = encoded_column(offset + 8)
+
+    return InventorySnapshot(ids, state_codes, zones, instance_types, launch_times, tags,
+                             created=created, source=json.loads(string(source_index)))
+
+
+def tags_to_query(tags):
+    """
+    Converts the tags accepted by get_reservations (a tag name, a dict of
+    tag names and values, or a list of either) to a query in which every
+    tag must match
+    """
+    if isinstance(tags, str):
+        try:
+            tags = literal_eval(tags)
+        except:
+            pass
+
+    query = []
+    for item in (tags if isinstance(tags, list) else [tags]):
+        if isinstance(item, dict):
+            item = _set_none_to_blank(item)
+            query.append(dict(("tag:" + tn, tv) for (tn, tv) in iteritems(item)))
+        elif item is not None:
+            query.append({"tag:" + item: {'exists': True}})
+    return query
+
+
+def _check_condition(field, condition):
+    if field == 'state':
+        for state in (condition if isinstance(condition, list) else [condition]):
+            if state not in INSTANCE_STATE_CODES:
+                raise ValueError('unknown state %r, expected one of %s' % (state, ', '.join(sorted(INSTANCE_STATE_CODES))))
+    elif field == 'launch_time':
+        if not isinstance(condition, dict) or not condition or set(condition) - set(['before', 'after']):
+            raise ValueError('launch_time takes a dict with before and/or after')
+        for value in condition.values():
+            try:
+                _launch_time_to_epoch(value)
+            except (TypeError, ValueError):
+                raise ValueError('launch_time %r is not a time such as 2016-08-01T12:00:00.000Z or seconds since the epoch' % (value,))
+    elif field in ('zone', 'instance_type') or field.startswith('tag:'):
+        if not isinstance(condition, dict):
+            return
+        for op, value in iteritems(condition):
+            if op == 'in' and not isinstance(value, list):
+                raise ValueError('the in operator of %s takes a list' % field)
+            elif op in ('prefix', 'regex') and not isinstance(value, string_types):
+                raise ValueError('the %s operator of %s takes a string' % (op, field))
+            elif op == 'regex':
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    raise ValueError('invalid regex %r for %s: %s' % (value, field, e))
+            elif op not in ('exists', 'in', 'prefix', 'regex'):
+                raise ValueError('unknown operator %r for %s' % (op, field))
+    else:
+        raise ValueError("unknown field %r, expected state, zone, instance_type, launch_time or tag:<key>" % (field,))
+
+
+def check_query(query):
+    """
+    Validates a query as accepted by InventorySnapshot.select, so that a
+    mistake is reported once instead of failing while instances are matched
+    Raises:
+        ValueError describing the first problem found
+    """
+    if query is None:
+        return
+    if isinstance(query, list):
+        for sub_query in query:
+            check_query(sub_query)
+        return
+    if not isinstance(query, dict):
+        raise ValueError('a query is a dict or a list of dicts, not %r' % (query,))
+    for key in ('and', 'or', 'not'):
+        if key in query:
+            if len(query) > 1:
+                raise ValueError("'%s' cannot be combined with other keys" % key)
+            if key != 'not' and not isinstance(query[key], list):
+                raise ValueError("'%s' takes a list of queries" % key)
+            check_query(query[key])
+            return
+    for field, condition in iteritems(query):
+        _check_condition(field, condition)
+
+
+def filter_reservations(reservations, query):
+    """
+    Drops the instances that do not match query from reservations, along
+    with any reservation that is left without instances
+    """
+    if not query:
+        return reservations
+    instances = []
+    for res in reservations:
+        instances.extend(res.instances)
+    selected = set(inst.id for inst in InventorySnapshot.from_instances(instances).filter(query))
+    filtered = []
+    for res in reservations:
+        res.instances = [inst for inst in res.instances if inst.id in selected]
+        if res.instances:
+            filtered.append(res)
+    return filtered
+
+
 def get_instance_info(inst):
     """
     Retrieves instance information from an instance
@@ -138,6 +960,35 @@ def get_instance_info(inst):
 
     return instance_info
 
+def index_instances(items):
+    """
+    Indexes instances by ID in a single pass, converting each one to a
+    dictionary once and keeping the first occurrence of every ID
+    items: any mix of reservations, boto instances and dictionaries
+      returned by get_instance_info
+    Returns:
+        OrderedDict of instance ID to instance dictionary
+    """
+    index = OrderedDict()
+    for item in items:
+        for inst in getattr(item, 'instances', [item]):
+            inst_id = inst['id'] if isinstance(inst, dict) else inst.id
+            if inst_id not in index:
+                index[inst_id] = inst if isinstance(inst, dict) else get_instance_info(inst)
+    return index
+
+
+def assemble_results(items):
+    """
+    Builds the instances and instance_ids results from reservations,
+    boto instances or instance dictionaries, without duplicates
+    Returns:
+        (list of instance dictionaries, list of instance ID's)
+    """
+    index = index_instances(items)
+    return list(index.values()), list(index.keys())
+
+
 def boto_supports_associate_public_ip_address(ec2):
     """
     Check if Boto library has associate_public_ip_address in the NetworkInterfaceSpecification
@@ -164,11 +1015,155 @@ def boto_supports_profile_name_arg(ec2):
     run_instances_method = getattr(ec2, 'run_instances')
     return 'instance_profile_name' in get_function_code(run_instances_method).co_varnames
 
-def create_block_device(module, ec2, volume):
-    # Not aware of a way to determine this programatically
-    # http://aws.amazon.com/about-aws/whats-new/2013/10/09/ebs-provisioned-iops-maximum-iops-gb-ratio-increased-to-30-1/
-    MAX_IOPS_TO_SIZE_RATIO = 30
+CAPABILITY_INDEX_VERSION = 1
+
+# Limits that can not be determined programatically. A newer index can be
+# supplied with the capability_index option; its top level keys replace
+# the ones below.
+DEFAULT_CAPABILITY_INDEX = {
+    'version': CAPABILITY_INDEX_VERSION,
+    'volume_types': {
+        'standard': {'min_size': 1, 'max_size': 1024},
+        'gp2': {'min_size': 1, 'max_size': 16384},
+        # http://aws.amazon.com/about-aws/whats-new/2013/10/09/ebs-provisioned-iops-maximum-iops-gb-ratio-increased-to-30-1/
+        'io1': {'min_size': 4, 'max_size': 16384, 'iops': True, 'max_iops_to_size_ratio': 30},
+        'st1': {'min_size': 500, 'max_size': 16384},
+        'sc1': {'min_size': 500, 'max_size': 16384},
+    },
+    # instance types, or type prefixes, that can not be launched EBS-optimized
+    'ebs_optimized_unsupported': ['t1.', 't2.', 'm1.small', 'm1.medium', 'm3.medium', 'c1.medium'],
+    # tenancies other than default, which spot requests do not accept
+    'spot_unsupported_tenancy': ['dedicated', 'host'],
+}
+
+_capability_index_cache = {}
+
+
+def load_capability_index(module, path=None):
+    """
+    Returns the capability index used to validate launch requests: the
+    built-in one, updated with the JSON index at path if given. The file is
+    parsed at most once per module run for a given path, size and
+    modification time, as validation and every launch (including each
+    reconcile run) look the index up.
+    """
+    if not path:
+        return DEFAULT_CAPABILITY_INDEX
+
+    try:
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime)
+        if key in _capability_index_cache:
+            return _capability_index_cache[key]
+        with open(path, 'rb') as f:
+            overrides = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg='Unable to load capability index {0}, error: {1}'.format(path, e))
+
+    if overrides.get('version') != CAPABILITY_INDEX_VERSION:
+        module.fail_json(msg='Unsupported capability index version {0} in {1}'.format(overrides.get('version'), path))
+
+    index = dict(DEFAULT_CAPABILITY_INDEX)
+    index.update(overrides)
+    _capability_index_cache[key] = index
+    return index
+
 
+def max_iops_to_size_ratio(limits):
+    """
+    Returns the IOPS to size ratio of a volume type's limits, falling back
+    to the built-in io1 ratio for an index that does not define one
+    """
+    return limits.get('max_iops_to_size_ratio',
+                      DEFAULT_CAPABILITY_INDEX['volume_types']['io1']['max_iops_to_size_ratio'])
+
+
+def validate_volume(volume, index):
+    """
+    Checks a volume definition against the capability index
+    Returns:
+        list of error messages, empty if the volume is valid
+    """
+    errors = []
+    if 'device_name' not in volume:
+        errors.append('Device name must be set for volume')
+    device = volume.get('device_name', 'volume')
+
+    if all(key in volume for key in ['device_type','volume_type']):
+        errors.append('%s: device_type is a deprecated name for volume_type. Do not use both device_type and volume_type' % device)
+    volume_type = volume.get('device_type') or volume.get('volume_type')
+    limits = index['volume_types'].get(volume_type or 'standard')
+
+    if limits is None:
+        errors.append('%s: unknown volume type %s' % (device, volume_type))
+        limits = {}
+    if 'ephemeral' in volume and 'snapshot' in volume:
+        errors.append('%s: Cannot set both ephemeral and snapshot' % device)
+    if 'snapshot' not in volume and 'ephemeral' not in volume and 'volume_size' not in volume:
+        errors.append('%s: Size must be specified when creating a new volume or modifying the root volume' % device)
+    if 'snapshot' in volume and 'encrypted' in volume:
+        errors.append('%s: You can not set encryption when creating a volume from a snapshot' % device)
+
+    size = volume.get('volume_size')
+    # a size of 0 asks for the volume not to be created
+    if size is not None and int(size) > 0 and 'ephemeral' not in volume:
+        if not limits.get('min_size', 1) <= int(size) <= limits.get('max_size', int(size)):
+            errors.append('%s: %s volumes must be between %d and %d GiB' % (
+                device, volume_type or 'standard', limits.get('min_size', 1), limits.get('max_size')))
+
+    if limits.get('iops') and 'iops' not in volume:
+        errors.append('%s: %s volumes must have an iops value set' % (device, volume_type))
+    if 'iops' in volume:
+        if not limits.get('iops'):
+            errors.append('%s: iops can not be set on %s volumes' % (device, volume_type or 'standard'))
+        elif size is not None and int(volume['iops']) > max_iops_to_size_ratio(limits) * int(size):
+            errors.append('%s: IOPS must be at most %d times greater than size' % (device, max_iops_to_size_ratio(limits)))
+
+    return errors
+
+
+def validate_launch_request(module, index):
+    """
+    Checks the whole launch request against the capability index and
+    fails with every problem found before any call is made to AWS
+    module: Ansible module object
+    index: capability index as returned by load_capability_index
+    """
+    params = module.params
+    errors = []
+    spot_price = params.get('spot_price')
+    instance_types = [params.get('instance_type')] + (params.get('instance_types') or [])
+
+    if params.get('ebs_optimized'):
+        for instance_type in instance_types:
+            if instance_type and any(instance_type.startswith(prefix) for prefix in index['ebs_optimized_unsupported']):
+                errors.append('instance type %s does not support ebs_optimized' % instance_type)
+
+    if params.get('group') and params.get('group_id'):
+        errors.append('Use only one type of parameter (group_name) or (group_id)')
+
+    if module.boolean(params.get('assign_public_ip')) and not params.get('vpc_subnet_id'):
+        errors.append('assign_public_ip only available with vpc_subnet_id')
+
+    if params.get('zones') and len(set([params.get('zone')] + params['zones']) - set([None])) > 1 and params.get('vpc_subnet_id'):
+        errors.append('zones can not be used with vpc_subnet_id, as a subnet belongs to a single zone')
+
+    if spot_price:
+        if params.get('tenancy') in index['spot_unsupported_tenancy']:
+            errors.append('tenancy %s is not supported for spot instances' % params.get('tenancy'))
+        if params.get('private_ip'):
+            errors.append('private_ip only available with on-demand (non-spot) instances')
+        if params.get('instance_initiated_shutdown_behavior') not in (None, 'terminate'):
+            errors.append('instance_initiated_shutdown_behavior=stop is not supported for spot instances.')
+
+    for volume in params.get('volumes') or []:
+        errors.extend(validate_volume(volume, index))
+
+    if errors:
+        module.fail_json(msg='Invalid launch request: %s' % '; '.join(errors))
+
+
+def create_block_device(module, ec2, volume, index=DEFAULT_CAPABILITY_INDEX):
     # device_type has been used historically to represent volume_type,
     # however ec2_vol uses volume_type, as does the BlockDeviceType, so
     # we add handling for either/or but not both
@@ -177,6 +1172,7 @@ def create_block_device(module, ec2, volume):
 
     # get whichever one is set, or NoneType if neither are set
     volume_type = volume.get('device_type') or volume.get('volume_type')
+    MAX_IOPS_TO_SIZE_RATIO = max_iops_to_size_ratio(index['volume_types'].get(volume_type or 'standard', {}))
 
     if 'snapshot' not in volume and 'ephemeral' not in volume:
         if 'volume_size' not in volume:
@@ -267,41 +1263,155 @@ def await_spot_requests(module, ec2, spot_requests, count):
     module.fail_json(msg = "wait for spot requests timeout on %s" % time.asctime())
 
 
-def enforce_count(module, ec2, vpc):
+def acquire_spot_capacity(module, ec2, params, spot_price, count, pools, journal=None, journal_path=None):
+    """
+    Acquires count spot instances by requesting them in several pools at
+    once and taking whichever capacity is fulfilled first.
+    module: Ansible module object
+    ec2: authenticated ec2 connection object
+    params: request_spot_instances keyword arguments shared by every request
+    spot_price: maximum price for the spot requests
+    count: Total number of instances to acquire
+    pools: list of (zone, instance_type) as returned by get_launch_pools
+    Requests are spread over pools (oversubscribed by spot_oversubscription)
+    and polled incrementally. Failed or closed requests have their shortfall
+    re-requested in the pools that have not failed yet. Once count instances
+    are fulfilled the open requests are cancelled and any surplus instances
+    are terminated. If spot_wait_timeout passes first, the open requests are
+    cancelled and the remainder is launched on-demand when
+    spot_fallback_on_demand is set. If a call fails, the open requests are
+    cancelled before failing and the instances fulfilled so far reported.
+    journal, journal_path: launch journal (see load_launch_journal) in which
+      every spot request is recorded as it is made, so that an interrupted
+      acquisition resumes polling the same requests
+    Returns:
+        list of instance ID's acquired
+    """
+    spot_wait_timeout = int(module.params.get('spot_wait_timeout'))
+    oversubscription = module.params.get('spot_oversubscription') or 1.0
+    workers = module.params.get('max_concurrency')
+    wait_complete = time.time() + spot_wait_timeout
 
-    exact_count = module.params.get('exact_count')
-    count_tag = module.params.get('count_tag')
-    zone = module.params.get('zone')
+    healthy_pools = list(pools)
+    open_requests = {}
+    fulfilled = []
+
+    def submit(shortfall):
+        targets = healthy_pools or list(pools)
+        total = int(math.ceil(shortfall * oversubscription))
+        requests = []
+        for index, pool in enumerate(targets):
+            share = total // len(targets) + (1 if index < total % len(targets) else 0)
+            if share > 0:
+                requests.append((pool, share))
+
+        # workers return their error so that the requests made by the
+        # others are still recorded, and cancelled if acquisition fails
+        def request(item):
+            (zone, instance_type), share = item
+            request_params = dict(params, placement=zone, instance_type=instance_type, count=share)
+            try:
+                return item[0], ec2.request_spot_instances(spot_price, **request_params), None
+            except boto.exception.BotoServerError as e:
+                return item[0], [], e
+
+        errors = []
+        for pool, spot_requests, error in _parallel_map(request, requests, workers):
+            if error is not None:
+                errors.append(error)
+            for sir in spot_requests:
+                open_requests[sir.id] = pool
+                if journal is not None:
+                    journal['spot_request_ids'].append(sir.id)
+                    journal.setdefault('spot_request_pools', {})[sir.id] = list(pool)
+        if journal is not None:
+            record_launch_step(module, journal_path, journal, 'spot_requested')
+        if errors:
+            raise errors[0]
+
+    def cancel_open_requests():
+        if not open_requests:
+            return
+        ec2.cancel_spot_instance_requests(list(open_requests))
+        # cancelling a request does not terminate its instance, so pick
+        # up the requests fulfilled since the last poll
+        for sir in ec2.get_all_spot_instance_requests(request_ids=list(open_requests)):
+            if sir.instance_id is not None and sir.instance_id not in fulfilled:
+                fulfilled.append(sir.instance_id)
+        open_requests.clear()
 
-    # fail here if the exact count was specified without filtering
-    # on a tag, as this may lead to a undesired removal of instances
-    if exact_count and count_tag is None:
-        module.fail_json(msg="you must use the 'count_tag' option with exact_count")
+    try:
+        if journal is not None and journal['spot_request_ids']:
+            # resume polling the requests made by the interrupted run
+            request_pools = journal.get('spot_request_pools', {})
+            for request_id in journal['spot_request_ids']:
+                open_requests[request_id] = tuple(request_pools.get(request_id, pools[0]))
+        else:
+            submit(count)
+        while time.time() < wait_complete and len(fulfilled) < count:
+            time.sleep(5)
+            shortfall = 0
+            for sir in ec2.get_all_spot_instance_requests(request_ids=list(open_requests)):
+                if sir.id not in open_requests:
+                    continue
+                if sir.instance_id is not None:
+                    fulfilled.append(sir.instance_id)
+                    del open_requests[sir.id]
+                elif sir.state in ('failed', 'cancelled', 'closed'):
+                    pool = open_requests.pop(sir.id)
+                    if pool in healthy_pools:
+                        healthy_pools.remove(pool)
+                    shortfall += 1
+            # only re-request what the open requests can no longer cover
+            shortfall = min(shortfall, count - len(fulfilled) - len(open_requests))
+            if shortfall > 0:
+                submit(shortfall)
+
+        cancel_open_requests()
+
+        if len(fulfilled) > count:
+            ec2.terminate_instances(fulfilled[count:])
+            fulfilled = fulfilled[:count]
+
+        remainder = count - len(fulfilled)
+        if remainder > 0:
+            if not module.params.get('spot_fallback_on_demand'):
+                module.fail_json(msg = "wait for spot requests timeout on %s, %d of %d instances fulfilled" % (
+                    time.asctime(), len(fulfilled), count), instance_ids=fulfilled)
+            on_demand_params = dict((k, v) for (k, v) in iteritems(params) if k not in ('type', 'count', 'launch_group'))
+            on_demand_params['tenancy'] = module.params.get('tenancy')
+            on_demand_params['instance_initiated_shutdown_behavior'] = 'terminate'
+            fulfilled.extend(i.id for i in split_launch(module, ec2, on_demand_params, remainder, pools))
+    except boto.exception.BotoServerError as e:
+        # leave no open request behind to be fulfilled after the module fails
+        try:
+            cancel_open_requests()
+        except boto.exception.BotoServerError:
+            pass
+        module.fail_json(msg = "Spot acquisition failed => %s: %s" % (e.error_code, e.error_message),
+                         instance_ids=fulfilled, spot_request_ids=sorted(open_requests))
 
-    reservations, instances = find_running_instances_by_count_tag(module, ec2, count_tag, zone)
+    return fulfilled
 
-    changed = None
-    checkmode = False
+
+def enforce_count(module, ec2, vpc):
+
+    plan, instances = plan_enforce_count(module, ec2)
+
+    changed = plan_has_changes(plan)
     instance_dict_array = []
     changed_instance_ids = None
 
-    if len(instances) == exact_count:
-        changed = False
-    elif len(instances) < exact_count:
-        changed = True
-        to_create = exact_count - len(instances)
-        if not checkmode:
+    if plan['launch'] > 0:
+        if not module.check_mode:
             (instance_dict_array, changed_instance_ids, changed) \
-                = create_instances(module, ec2, vpc, override_count=to_create)
+                = create_instances(module, ec2, vpc, override_count=plan['launch'])
 
             for inst in instance_dict_array:
                 instances.append(inst)
-    elif len(instances) > exact_count:
-        changed = True
-        to_remove = len(instances) - exact_count
-        if not checkmode:
-            all_instance_ids = sorted([ x.id for x in instances ])
-            remove_ids = all_instance_ids[0:to_remove]
+    elif plan['terminate']:
+        if not module.check_mode:
+            remove_ids = plan['terminate']
 
             instances = [ x for x in instances if x.id not in remove_ids]
 
@@ -313,16 +1423,414 @@ def enforce_count(module, ec2, vpc):
                 terminated_list.append(inst)
             instance_dict_array = terminated_list
 
-    # ensure all instances are dictionaries
-    all_instances = []
-    for inst in instances:
-        if not isinstance(inst, dict):
-            inst = get_instance_info(inst)
-        all_instances.append(inst)
+    all_instances = assemble_results(instances)[0]
 
     return (all_instances, instance_dict_array, changed_instance_ids, changed)
 
 
+def _read_scale_request(module, path, last_mtime):
+    """
+    Reads the scale request file written by operators or autoscaling hooks
+    in the form {"exact_count": N}
+    Returns:
+        (modification time, requested count) or (last_mtime, None) when the
+        file is missing or has not changed since last_mtime
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return last_mtime, None
+    if mtime == last_mtime:
+        return last_mtime, None
+    try:
+        with open(path) as f:
+            return mtime, int(json.load(f)['exact_count'])
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        module.warn('Ignoring invalid scale request in {0}: {1}'.format(path, e))
+        return mtime, None
+
+
+def reconcile_daemon(module, ec2, vpc):
+    """
+    Keeps exact_count instances running by calling enforce_count every
+    reconcile_interval seconds for reconcile_max_runs runs, reusing the
+    same connections and module state between runs.
+    module: Ansible module object
+    ec2: authenticated ec2 connection object
+    vpc: authenticated vpc connection object
+    Writing {"exact_count": N} to reconcile_trigger_path starts a run
+    straight away; requests written while a run is in progress or before
+    the next run are coalesced, and only the latest count is applied.
+    Metrics are written to metrics_path after each run.
+    Returns:
+        (all_instances, instance_dict_array, changed_instance_ids, changed, metrics)
+        where all_instances comes from the last successful run, and
+        instance_dict_array and changed_instance_ids accumulate over every run
+    """
+    interval = module.params.get('reconcile_interval')
+    max_runs = module.params.get('reconcile_max_runs')
+    trigger_path = module.params.get('reconcile_trigger_path')
+    metrics_path = module.params.get('metrics_path')
+
+    # a module run has to return for its result to be reported
+    if max_runs is None or max_runs < 1:
+        module.fail_json(msg='reconcile_interval requires reconcile_max_runs of at least 1')
+
+    metrics = {'runs': 0,
+               'errors': 0,
+               'launched': 0,
+               'terminated': 0,
+               'scale_requests': 0,
+               'coalesced_scale_requests': 0,
+               'desired_count': module.params.get('exact_count'),
+               'running_count': None,
+               'last_run': None,
+               'last_duration_seconds': None,
+               'total_duration_seconds': 0.0,
+               }
+    all_instances = []
+    instance_dict_array = []
+    changed_instance_ids = []
+    changed = False
+    # only requests written while the module runs count, not a file left
+    # behind by an earlier run
+    trigger_mtime = None
+    if trigger_path and os.path.exists(trigger_path):
+        trigger_mtime = os.stat(trigger_path).st_mtime
+    next_run = time.time()
+
+    while metrics['runs'] < max_runs:
+        pending_requests = 0
+        while True:
+            if trigger_path:
+                trigger_mtime, requested = _read_scale_request(module, trigger_path, trigger_mtime)
+                if requested is not None:
+                    pending_requests += 1
+                    module.params['exact_count'] = requested
+                    next_run = time.time()
+            if time.time() >= next_run:
+                break
+            time.sleep(max(0, min(1, next_run - time.time())))
+
+        metrics['scale_requests'] += pending_requests
+        metrics['coalesced_scale_requests'] += max(pending_requests - 1, 0)
+        metrics['desired_count'] = module.params['exact_count']
+
+        started = time.time()
+        try:
+            (run_instances, run_dict_array, run_ids, run_changed) = enforce_count(module, ec2, vpc)
+        except boto.exception.BotoServerError as e:
+            metrics['errors'] += 1
+            module.warn('Reconcile run failed => %s: %s' % (e.error_code, e.error_message))
+        else:
+            all_instances = run_instances
+            if run_changed:
+                changed = True
+                terminated = len([d for d in run_dict_array if d.get('state') == 'terminated'])
+                metrics['terminated'] += terminated
+                metrics['launched'] += len(run_dict_array) - terminated
+                instance_dict_array.extend(run_dict_array)
+                changed_instance_ids.extend(run_ids or [])
+            metrics['running_count'] = len(all_instances)
+        duration = time.time() - started
+
+        metrics['runs'] += 1
+        metrics['last_run'] = started
+        metrics['last_duration_seconds'] = round(duration, 3)
+        metrics['total_duration_seconds'] = round(metrics['total_duration_seconds'] + duration, 3)
+        if metrics_path:
+            try:
+                _write_json_atomic(metrics_path, metrics)
+            except (IOError, OSError) as e:
+                module.warn('Unable to write metrics to {0}: {1}'.format(metrics_path, e))
+
+        next_run = started + interval
+
+    return (all_instances, instance_dict_array, changed_instance_ids, changed, metrics)
+
+
+# run_instances error codes after which a pool is skipped and its shortfall
+# is retried in the next zone or instance type
+CAPACITY_ERROR_CODES = ('InsufficientInstanceCapacity', 'InsufficientCapacity',
+                        'Unsupported', 'InstanceLimitExceeded')
+
+
+def get_launch_pools(module):
+    """
+    Returns the (zone, instance_type) pools a launch may use, in order of
+    preference: every zone for the requested instance_type, then every
+    zone for each of the fallback instance_types in turn
+    """
+    def unique(values):
+        result = []
+        for value in values:
+            if value not in result:
+                result.append(value)
+        return result
+
+    zone = module.params.get('zone')
+    zones = unique(([zone] if zone else []) + (module.params.get('zones') or [])) or [zone]
+    instance_type = module.params.get('instance_type')
+    instance_types = unique([instance_type] + (module.params.get('instance_types') or []))
+
+    if len(zones) > 1 and module.params.get('vpc_subnet_id'):
+        module.fail_json(msg="zones can not be used with vpc_subnet_id, as a subnet belongs to a single zone")
+
+    return [(z, t) for t in instance_types for z in zones]
+
+
+def split_launch(module, ec2, params, count, pools, on_request=None, retries=3):
+    """
+    Launches count instances by splitting the request into parallel
+    run_instances calls across pools, retrying any shortfall in the next
+    pools when a zone or instance type runs out of capacity. Throttled or
+    failed calls are retried with backoff under the same client token.
+    module: Ansible module object
+    ec2: authenticated ec2 connection object
+    params: run_instances keyword arguments shared by every sub-request
+    count: Total number of instances to launch
+    pools: list of (zone, instance_type) as returned by get_launch_pools
+    on_request: called with the client tokens of each round of sub-requests
+      before they are made
+    Returns:
+        list of boto instances launched by all of the sub-requests
+    """
+    batch_size = module.params.get('launch_batch_size')
+    workers = module.params.get('max_concurrency')
+    client_token = params.get('client_token')
+
+    launched = []
+    failures = []
+    remaining = count
+    pools = list(pools)
+    sequence = [0]
+
+    # workers return their error so that the instances launched by the
+    # other sub-requests are still accounted for
+    def launch(request):
+        zone, instance_type, size, token = request
+        request_params = dict(params, placement=zone, instance_type=instance_type,
+                              min_count=1, max_count=size, client_token=token)
+        for attempt in range(retries + 1):
+            try:
+                return zone, instance_type, size, ec2.run_instances(**request_params).instances, None
+            except boto.exception.BotoServerError as e:
+                if e.error_code not in RETRYABLE_ERROR_CODES or attempt == retries:
+                    return zone, instance_type, size, [], e
+                time.sleep(2 ** attempt)
+
+    while remaining > 0 and pools:
+        # spread the shortfall across every zone of the most preferred
+        # instance type that still has pools left
+        current_type = pools[0][1]
+        round_pools = [pool for pool in pools if pool[1] == current_type]
+        requests = []
+        for index, (zone, instance_type) in enumerate(round_pools):
+            share = remaining // len(round_pools) + (1 if index < remaining % len(round_pools) else 0)
+            while share > 0:
+                size = min(share, batch_size or share)
+                token = None
+                if client_token:
+                    token = '%s-%d' % (client_token[:56], sequence[0])
+                sequence[0] += 1
+                requests.append((zone, instance_type, size, token))
+                share -= size
+
+        if on_request is not None and client_token:
+            on_request([request[3] for request in requests])
+
+        errors = []
+        for zone, instance_type, size, instances, error in _parallel_map(launch, requests, workers):
+            launched.extend(instances)
+            remaining -= len(instances)
+            if error is not None and error.error_code not in CAPACITY_ERROR_CODES:
+                errors.append(error)
+                continue
+            # a pool that could not fill its sub-request is out of capacity
+            if len(instances) < size and (zone, instance_type) in pools:
+                pools.remove((zone, instance_type))
+                failures.append('%s/%s: %s' % (zone, instance_type, error.error_code if error else 'partial fulfilment'))
+
+        if errors:
+            module.fail_json(msg = "Instance creation failed => %s" % '; '.join(
+                                 '%s: %s' % (e.error_code, e.error_message) for e in errors),
+                             instance_ids=[i.id for i in launched])
+
+    if remaining > 0:
+        module.fail_json(msg="Unable to launch %d of %d instances, capacity exhausted in %s" % (remaining, count, ', '.join(failures)),
+                         instance_ids=[i.id for i in launched])
+
+    return launched
+
+
+# EC2 rejects user data larger than this, before base64 encoding
+MAX_USER_DATA_SIZE = 16384
+
+# cloud-init part types, recognised by the first line of each part
+USER_DATA_PART_TYPES = (('#cloud-config', 'cloud-config'),
+                        ('#!', 'x-shellscript'),
+                        ('#include', 'x-include-url'),
+                        ('#cloud-boothook', 'cloud-boothook'),
+                        ('#upstart-job', 'upstart-job'),
+                        ('#part-handler', 'part-handler'),
+                        )
+
+
+def _gzip_bytes(data):
+    # a fixed mtime keeps the output identical for identical input
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def render_user_data(parts, user_data_format, digest):
+    """
+    Encodes user data parts in the requested format: raw (the single part
+    as is), gzip, or multipart-gzip (a cloud-init MIME multi-part archive,
+    gzipped)
+    Returns:
+        the encoded user data as bytes
+    """
+    if user_data_format == 'multipart-gzip':
+        # deriving the boundary from the content keeps the encoding stable
+        archive = MIMEMultipart(boundary='===============%s==' % digest[:32])
+        for index, part in enumerate(parts):
+            subtype = 'plain'
+            for (prefix, part_type) in USER_DATA_PART_TYPES:
+                if part.startswith(prefix):
+                    subtype = part_type
+                    break
+            try:
+                part.encode('ascii')
+                charset = 'us-ascii'
+            except UnicodeError:
+                charset = 'utf-8'
+            # us-ascii parts are sent as they are rather than base64 encoded
+            message = MIMEText(part, subtype, charset)
+            message.add_header('Content-Disposition', 'attachment', filename='part-%03d' % index)
+            archive.attach(message)
+        return _gzip_bytes(archive.as_string().encode('utf-8'))
+
+    data = parts[0].encode('utf-8')
+    if user_data_format == 'gzip':
+        return _gzip_bytes(data)
+    return data
+
+
+def prepare_user_data(module):
+    """
+    Packages user_data and user_data_parts according to user_data_format,
+    failing locally when the result exceeds the EC2 size limit. With
+    user_data_cache_dir set, encoded payloads are cached on disk under the
+    SHA-256 of their input, so repeated launches (such as exact_count
+    top-ups) skip encoding.
+    Returns:
+        the user data to pass to run_instances, or None
+    """
+    user_data = module.params.get('user_data')
+    parts = ([user_data] if user_data else []) + (module.params.get('user_data_parts') or [])
+    if not parts:
+        return None
+
+    user_data_format = module.params.get('user_data_format')
+    if user_data_format != 'multipart-gzip' and len(parts) > 1:
+        module.fail_json(msg='user_data_parts requires user_data_format=multipart-gzip')
+
+    # raw user data is passed on as given, which may be a single
+    # user_data_parts entry, and has no encoding worth caching
+    if user_data_format == 'raw':
+        encoded = render_user_data(parts, user_data_format, None)
+        if len(encoded) > MAX_USER_DATA_SIZE:
+            module.fail_json(msg='user_data is %d bytes once encoded as %s, above the %d bytes EC2 accepts' % (
+                len(encoded), user_data_format, MAX_USER_DATA_SIZE))
+        return parts[0]
+
+    digest = hashlib.sha256(json.dumps([user_data_format, parts]).encode('utf-8')).hexdigest()
+    cache_dir = module.params.get('user_data_cache_dir')
+    cache_path = cache_dir and os.path.join(cache_dir, digest + '.user-data')
+
+    encoded = None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            encoded = f.read()
+    if encoded is None:
+        encoded = render_user_data(parts, user_data_format, digest)
+
+    if len(encoded) > MAX_USER_DATA_SIZE:
+        module.fail_json(msg='user_data is %d bytes once encoded as %s, above the %d bytes EC2 accepts' % (
+            len(encoded), user_data_format, MAX_USER_DATA_SIZE))
+
+    if cache_path and not os.path.exists(cache_path):
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.ec2-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError) as e:
+            module.warn('Unable to cache user_data in {0}: {1}'.format(cache_dir, e))
+
+    return encoded
+
+
+LAUNCH_JOURNAL_VERSION = 1
+
+
+def load_launch_journal(module, path, client_token):
+    """
+    Returns the launch journal stored at path, or a new one.
+    module: Ansible module object
+    path: location of the journal file
+    client_token: the id parameter, or None to have the journal generate one
+    A journal for a different client token is replaced, as is a completed
+    journal whose token was generated, so that every new launch (such as an
+    exact_count top-up) gets a fresh token.
+    """
+    journal = None
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                journal = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            module.fail_json(msg='Unable to load launch journal {0}, error: {1}'.format(path, e))
+
+    if journal is not None and journal.get('version') == LAUNCH_JOURNAL_VERSION:
+        if client_token is None and not journal['user_token'] and 'complete' not in journal['steps']:
+            return journal
+        if client_token is not None and journal['client_token'] == client_token:
+            return journal
+
+    return {'version': LAUNCH_JOURNAL_VERSION,
+            'client_token': client_token or uuid.uuid4().hex,
+            'user_token': client_token is not None,
+            'steps': [],
+            'client_tokens': [],
+            'spot_request_ids': [],
+            'instance_ids': [],
+            'instances': [],
+            }
+
+
+def launch_step_done(journal, step):
+    return journal is not None and step in journal['steps']
+
+
+def record_launch_step(module, path, journal, step, **fields):
+    """
+    Marks step as completed in the journal, along with any fields it
+    produced, and persists the journal before the next step starts
+    """
+    journal.update(fields)
+    if step not in journal['steps']:
+        journal['steps'].append(step)
+    try:
+        _write_json_atomic(path, journal)
+    except (IOError, OSError) as e:
+        module.fail_json(msg='Unable to save launch journal {0}, error: {1}'.format(path, e))
+
+
 def create_instances(module, ec2, vpc, override_count=None):
     """
     Creates new instances
@@ -354,7 +1862,7 @@ def create_instances(module, ec2, vpc, override_count=None):
     wait_timeout = int(module.params.get('wait_timeout'))
     spot_wait_timeout = int(module.params.get('spot_wait_timeout'))
     placement_group = module.params.get('placement_group')
-    user_data = module.params.get('user_data')
+    user_data = prepare_user_data(module)
     instance_tags = module.params.get('instance_tags')
     vpc_subnet_id = module.params.get('vpc_subnet_id')
     assign_public_ip = module.boolean(module.params.get('assign_public_ip'))
@@ -369,6 +1877,14 @@ def create_instances(module, ec2, vpc, override_count=None):
     network_interfaces = module.params.get('network_interfaces')
     spot_launch_group = module.params.get('spot_launch_group')
     instance_initiated_shutdown_behavior = module.params.get('instance_initiated_shutdown_behavior')
+    launch_journal = module.params.get('launch_journal')
+
+    journal = None
+    if launch_journal:
+        journal = load_launch_journal(module, launch_journal, id)
+        if 'complete' in journal['steps']:
+            return (journal['instances'], journal['instance_ids'], False)
+        id = journal['client_token']
 
     # group_id and group_name are exclusive of each other
     if group_id and group_name:
@@ -406,25 +1922,56 @@ def create_instances(module, ec2, vpc, override_count=None):
     except boto.exception.NoAuthHandlerFound as e:
             module.fail_json(msg = str(e))
 
+    launch_pools = get_launch_pools(module)
+
     # Lookup any instances that much our run id.
 
     running_instances = []
+    recovered_ids = []
     count_remaining = int(count)
 
-    if id != None:
-        filter_dict = {'client-token':id, 'instance-state-name' : 'running'}
-        previous_reservations = ec2.get_all_instances(None, filter_dict)
-        for res in previous_reservations:
-            for prev_instance in res.instances:
-                running_instances.append(prev_instance)
-        count_remaining = count_remaining - len(running_instances)
+    if journal is None:
+        if id != None:
+            filter_dict = {'client-token':id, 'instance-state-name' : 'running'}
+            previous_reservations = ec2.get_all_instances(None, filter_dict)
+            for res in previous_reservations:
+                for prev_instance in res.instances:
+                    running_instances.append(prev_instance)
+            count_remaining = count_remaining - len(running_instances)
+    elif journal['steps'] and not launch_step_done(journal, 'launched'):
+        # An interrupted run may have launched instances under any of the
+        # tokens it recorded. Nothing can be running under the token of a new
+        # journal yet, and a journal past the launch step already knows its
+        # instance IDs.
+        filter_dict = {'client-token': journal.get('client_tokens') or [id],
+                       'instance-state-name': ['pending', 'running']}
+        for res in ec2.get_all_instances(None, filter_dict):
+            recovered_ids.extend(i.id for i in res.instances)
+        count_remaining = count_remaining - len(recovered_ids)
 
     # Both min_count and max_count equal count parameter. This means the launch request is explicit (we want count, or fail) in how many instances we want.
 
-    if count_remaining == 0:
+    if launch_step_done(journal, 'launched'):
+        changed = True
+        instids = journal['instance_ids']
+    elif count_remaining <= 0 and recovered_ids:
+        # the interrupted run had launched everything before it stopped
+        changed = True
+        instids = recovered_ids
+        record_launch_step(module, launch_journal, journal, 'launched', instance_ids=list(instids))
+    elif count_remaining == 0:
         changed = False
     else:
         changed = True
+        if journal is not None:
+            # EC2 rejects a reused token whose request differs, so a launch
+            # resumed for the remaining count needs a token of its own
+            client_tokens = journal.get('client_tokens', [])
+            if client_tokens:
+                id = '%s-r%d' % (journal['client_token'][:56], len(client_tokens))
+            # persist the token before anything is launched under it
+            record_launch_step(module, launch_journal, journal, 'requested',
+                               client_tokens=client_tokens + [id])
         try:
             params = {'image_id': image,
                       'key_name': key_name,
@@ -491,6 +2038,7 @@ def create_instances(module, ec2, vpc, override_count=None):
                         params['security_groups'] = group_name
 
             if volumes:
+                capability_index = load_capability_index(module, module.params.get('capability_index'))
                 bdm = BlockDeviceMapping()
                 for volume in volumes:
                     if 'device_name' not in volume:
@@ -498,7 +2046,7 @@ def create_instances(module, ec2, vpc, override_count=None):
                     # Minimum volume size is 1GB. We'll use volume size explicitly set to 0
                     # to be a signal not to create this volume
                     if 'volume_size' not in volume or int(volume['volume_size']) > 0:
-                        bdm[volume['device_name']] = create_block_device(module, ec2, volume)
+                        bdm[volume['device_name']] = create_block_device(module, ec2, volume, capability_index)
 
                 params['block_device_map'] = bdm
 
@@ -524,8 +2072,17 @@ def create_instances(module, ec2, vpc, override_count=None):
                 # (the default) or 'terminate' here.
                 params['instance_initiated_shutdown_behavior'] = instance_initiated_shutdown_behavior or 'stop'
 
-                res = ec2.run_instances(**params)
-                instids = [ i.id for i in res.instances ]
+                if len(launch_pools) > 1:
+                    record_tokens = None
+                    if journal is not None:
+                        def record_tokens(tokens):
+                            record_launch_step(module, launch_journal, journal, 'requested',
+                                               client_tokens=journal['client_tokens'] + tokens)
+                    launched = split_launch(module, ec2, params, count_remaining, launch_pools,
+                                            on_request=record_tokens)
+                else:
+                    launched = ec2.run_instances(**params).instances
+                instids = [ i.id for i in launched ]
                 while True:
                     try:
                         ec2.get_all_instances(instids)
@@ -541,7 +2098,7 @@ def create_instances(module, ec2, vpc, override_count=None):
                 # terminated state due to idempotency. See commit 7f11c3d for a complete
                 # explanation.
                 terminated_instances = [
-                    str(instance.id) for instance in res.instances if instance.state == 'terminated'
+                    str(instance.id) for instance in launched if instance.state == 'terminated'
                 ]
                 if terminated_instances:
                     module.fail_json(msg = "Instances with id(s) %s " % terminated_instances +
@@ -571,14 +2128,32 @@ def create_instances(module, ec2, vpc, override_count=None):
                     count = count_remaining,
                     type = spot_type,
                 ))
-                res = ec2.request_spot_instances(spot_price, **params)
-
-                # Now we have to do the intermediate waiting
-                if wait:
-                    instids = await_spot_requests(module, ec2, res, count)
+                if len(launch_pools) > 1 or module.params.get('spot_fallback_on_demand'):
+                    del params['count']
+                    instids = acquire_spot_capacity(module, ec2, params, spot_price, count_remaining, launch_pools,
+                                                    journal=journal, journal_path=launch_journal)
+                else:
+                    if journal is not None and journal['spot_request_ids']:
+                        # resume waiting on the requests made by the interrupted run
+                        res = ec2.get_all_spot_instance_requests(request_ids=journal['spot_request_ids'])
+                    else:
+                        res = ec2.request_spot_instances(spot_price, **params)
+                        if journal is not None:
+                            record_launch_step(module, launch_journal, journal, 'spot_requested',
+                                               spot_request_ids=[sir.id for sir in res])
+
+                    # Now we have to do the intermediate waiting
+                    if wait:
+                        instids = await_spot_requests(module, ec2, res, count)
         except boto.exception.BotoServerError as e:
             module.fail_json(msg = "Instance creation failed => %s: %s" % (e.error_code, e.error_message))
 
+        if recovered_ids:
+            instids = recovered_ids + list(instids)
+        if journal is not None:
+            record_launch_step(module, launch_journal, journal, 'launched', instance_ids=list(instids))
+
+    if changed and not launch_step_done(journal, 'running'):
         # wait here until the instances are up
         num_running = 0
         wait_timeout = time.time() + wait_timeout
@@ -613,30 +2188,50 @@ def create_instances(module, ec2, vpc, override_count=None):
         for res in res_list:
             running_instances.extend(res.instances)
 
+        if journal is not None:
+            record_launch_step(module, launch_journal, journal, 'running')
+
+    if changed:
         # Enabled by default by AWS
-        if source_dest_check is False:
-            for inst in res.instances:
-                inst.modify_attribute('sourceDestCheck', False)
+        if source_dest_check is False and not launch_step_done(journal, 'source_dest_check'):
+            for inst_id in instids:
+                ec2.modify_instance_attribute(inst_id, 'sourceDestCheck', False)
+            if journal is not None:
+                record_launch_step(module, launch_journal, journal, 'source_dest_check')
 
         # Disabled by default by AWS
-        if termination_protection is True:
-            for inst in res.instances:
-                inst.modify_attribute('disableApiTermination', True)
+        if termination_protection is True and not launch_step_done(journal, 'termination_protection'):
+            for inst_id in instids:
+                ec2.modify_instance_attribute(inst_id, 'disableApiTermination', True)
+            if journal is not None:
+                record_launch_step(module, launch_journal, journal, 'termination_protection')
 
         # Leave this as late as possible to try and avoid InvalidInstanceID.NotFound
-        if instance_tags:
+        if instance_tags and not launch_step_done(journal, 'tags'):
             try:
                 ec2.create_tags(instids, instance_tags)
             except boto.exception.EC2ResponseError as e:
                 module.fail_json(msg = "Instance tagging failed => %s: %s" % (e.error_code, e.error_message))
-
-    instance_dict_array = []
-    created_instance_ids = []
-    for inst in running_instances:
-        inst.update()
-        d = get_instance_info(inst)
-        created_instance_ids.append(inst.id)
-        instance_dict_array.append(d)
+            if journal is not None:
+                record_launch_step(module, launch_journal, journal, 'tags')
+
+        # the waits were skipped when resuming, so look the instances up once
+        if not running_instances and instids:
+            for res in ec2.get_all_instances(list(instids)):
+                running_instances.extend(res.instances)
+
+    # running_instances come from describe calls made after the launch, so
+    # only the tags added since then are missing from them
+    (instance_dict_array, created_instance_ids) = assemble_results(running_instances)
+    if changed and instance_tags:
+        tagged_ids = set(instids)
+        for d in instance_dict_array:
+            if d['id'] in tagged_ids:
+                d['tags'] = dict(d['tags'] or {})
+                d['tags'].update(instance_tags)
+
+    if journal is not None:
+        record_launch_step(module, launch_journal, journal, 'complete', instances=instance_dict_array)
 
     return (instance_dict_array, created_instance_ids, changed)
 
@@ -677,8 +2272,9 @@ def terminate_instances(module, ec2, instance_ids):
                 changed = True
 
     # wait here until the instances are 'terminated'
-    if wait:
+    if wait and terminated_instance_ids:
         num_terminated = 0
+        response = []
         wait_timeout = time.time() + wait_timeout
         while wait_timeout > time.time() and num_terminated < len(terminated_instance_ids):
             response = ec2.get_all_instances( \
@@ -699,16 +2295,59 @@ def terminate_instances(module, ec2, instance_ids):
         if wait_timeout < time.time() and num_terminated < len(terminated_instance_ids):
             module.fail_json(msg = "wait for instance termination timeout on %s" % time.asctime())
         #Lets get the current state of the instances after terminating - issue600
-        instance_dict_array = []
-        for res in ec2.get_all_instances(instance_ids=terminated_instance_ids,\
-                                            filters={'instance-state-name':'terminated'}):
-            for inst in res.instances:
-                instance_dict_array.append(get_instance_info(inst))
-
+        #the last poll above already described every terminated instance
+        instance_dict_array = assemble_results(response)[0]
 
     return (changed, instance_dict_array, terminated_instance_ids)
 
 
+# error codes worth retrying a call for, after backing off
+RETRYABLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'InternalError', 'Unavailable')
+
+
+def find_drifted_interfaces(ec2, instance_ids, source_dest_check):
+    """
+    Looks up the network interfaces of all instance_ids with a single
+    DescribeNetworkInterfaces call
+    Returns:
+        list of the interfaces whose source_dest_check differs from the
+        requested value
+    """
+    if not instance_ids:
+        return []
+    interfaces = ec2.get_all_network_interfaces(filters={'attachment.instance-id': list(instance_ids)})
+    return [eni for eni in interfaces if eni.source_dest_check != source_dest_check]
+
+
+def sync_interface_source_dest_check(module, ec2, instance_ids, source_dest_check, retries=3):
+    """
+    Sets source_dest_check on the interfaces of instances with more than
+    one Elastic Network Interface, which define the attribute per-interface.
+    Only drifted interfaces are modified, in parallel (bounded by
+    max_concurrency), retrying throttled or failed calls with backoff.
+    Returns:
+        True if any interface was modified, else False
+    """
+    drifted = find_drifted_interfaces(ec2, instance_ids, source_dest_check)
+
+    # workers return their error so that the module fails once, after
+    # every interface has been tried
+    def modify(interface):
+        for attempt in range(retries + 1):
+            try:
+                ec2.modify_network_interface_attribute(interface.id, "sourceDestCheck", source_dest_check)
+                return None
+            except boto.exception.EC2ResponseError as exc:
+                if exc.error_code not in RETRYABLE_ERROR_CODES or attempt == retries:
+                    return '{0}: {1}'.format(interface.id, exc)
+                time.sleep(2 ** attempt)
+
+    errors = [error for error in _parallel_map(modify, drifted, module.params.get('max_concurrency')) if error]
+    if errors:
+        module.fail_json(msg='Failed to handle source_dest_check state for interfaces, error: {0}'.format('; '.join(errors)))
+    return bool(drifted)
+
+
 def startstop_instances(module, ec2, instance_ids, state, instance_tags):
     """
     Starts or stops a list of existing instances
@@ -751,7 +2390,9 @@ def startstop_instances(module, ec2, instance_ids, state, instance_tags):
 
     # Check (and eventually change) instances attributes and instances state
     existing_instances_array = []
-    for res in ec2.get_all_instances(instance_ids, filters=filters):
+    multi_eni_instance_ids = []
+    for res in filter_reservations(describe_instances(module, ec2, instance_ids, filters),
+                                   module.params.get('instance_filter')):
         for inst in res.instances:
 
             # Check "source_dest_check" attribute
@@ -764,10 +2405,7 @@ def startstop_instances(module, ec2, instance_ids, state, instance_tags):
                 # fail, because they have the sourceDestCheck attribute defined
                 # per-interface
                 if exc.code == 'InvalidInstanceID':
-                    for interface in inst.interfaces:
-                        if interface.source_dest_check != source_dest_check:
-                            ec2.modify_network_interface_attribute(interface.id, "sourceDestCheck", source_dest_check)
-                            changed = True
+                    multi_eni_instance_ids.append(inst.id)
                 else:
                     module.fail_json(msg='Failed to handle source_dest_check state for instance {0}, error: {1}'.format(inst.id, exc),
                                      exception=traceback.format_exc(exc))
@@ -791,6 +2429,9 @@ def startstop_instances(module, ec2, instance_ids, state, instance_tags):
                 changed = True
             existing_instances_array.append(inst.id)
 
+    if sync_interface_source_dest_check(module, ec2, multi_eni_instance_ids, source_dest_check):
+        changed = True
+
     instance_ids = list(set(existing_instances_array + (instance_ids or [])))
     ## Wait for all the instances to finish starting or stopping
     wait_timeout = time.time() + wait_timeout
@@ -827,15 +2468,20 @@ def restart_instances(module, ec2, instance_ids, state, instance_tags):
     about the instances.
     If the instance was not able to change state,
     "changed" will be set to False.
-    Wait will not apply here as this is a OS level operation.
+    Wait will not apply here as this is a OS level operation, unless
+    restart_batch_size is set: instances are then rebooted in batches, each
+    batch waiting for its status checks to pass before the next one starts.
     Note that if instance_ids and instance_tags are both non-empty,
     this method will process the intersection of the two.
+    Returns the timings of each batch as a fourth value.
     """
 
     source_dest_check = module.params.get('source_dest_check')
     termination_protection = module.params.get('termination_protection')
+    restart_batch_size = module.params.get('restart_batch_size')
     changed = False
     instance_dict_array = []
+    to_reboot = []
 
     if not isinstance(instance_ids, list) or len(instance_ids) < 1:
         # Fail unless the user defined instance tags
@@ -853,7 +2499,9 @@ def restart_instances(module, ec2, instance_ids, state, instance_tags):
      # Check that our instances are not in the state we want to take
 
     # Check (and eventually change) instances attributes and instances state
-    for res in ec2.get_all_instances(instance_ids, filters=filters):
+    multi_eni_instance_ids = []
+    for res in filter_reservations(describe_instances(module, ec2, instance_ids, filters),
+                                   module.params.get('instance_filter')):
         for inst in res.instances:
 
             # Check "source_dest_check" attribute
@@ -866,10 +2514,7 @@ def restart_instances(module, ec2, instance_ids, state, instance_tags):
                 # fail, because they have the sourceDestCheck attribute defined
                 # per-interface
                 if exc.code == 'InvalidInstanceID':
-                    for interface in inst.interfaces:
-                        if interface.source_dest_check != source_dest_check:
-                            ec2.modify_network_interface_attribute(interface.id, "sourceDestCheck", source_dest_check)
-                            changed = True
+                    multi_eni_instance_ids.append(inst.id)
                 else:
                     module.fail_json(msg='Failed to handle source_dest_check state for instance {0}, error: {1}'.format(inst.id, exc),
                                      exception=traceback.format_exc(exc))
@@ -883,13 +2528,467 @@ def restart_instances(module, ec2, instance_ids, state, instance_tags):
             # Check instance state
             if inst.state != state:
                 instance_dict_array.append(get_instance_info(inst))
-                try:
-                    inst.reboot()
-                except EC2ResponseError as e:
-                    module.fail_json(msg='Unable to change state for instance {0}, error: {1}'.format(inst.id, e))
+                to_reboot.append(inst)
                 changed = True
 
-    return (changed, instance_dict_array, instance_ids)
+    if sync_interface_source_dest_check(module, ec2, multi_eni_instance_ids, source_dest_check):
+        changed = True
+
+    batches = []
+    if restart_batch_size:
+        for start in range(0, len(to_reboot), restart_batch_size):
+            batches.append(rolling_restart_batch(module, ec2, to_reboot[start:start + restart_batch_size]))
+    else:
+        for inst in to_reboot:
+            try:
+                inst.reboot()
+            except EC2ResponseError as e:
+                module.fail_json(msg='Unable to change state for instance {0}, error: {1}'.format(inst.id, e))
+
+    return (changed, instance_dict_array, instance_ids, batches)
+
+
+def await_instance_status_ok(module, ec2, instance_ids, wait_timeout, settle_until=0):
+    """
+    Waits until the system and instance status checks of every instance
+    report ok, or fails
+    module: Ansible module object
+    ec2: authenticated ec2 connection object
+    instance_ids: list of instance ID's to wait for
+    wait_timeout: time (as returned by time.time()) to give up at
+    settle_until: time before which an ok status only counts once the
+      instance has been seen not running or with checks that are not ok
+    The checks of an instance that was just rebooted may still report the
+    ok from before the reboot. An instance is therefore taken as healthy
+    after it was seen going through a reboot, or, since a quick reboot can
+    happen between two polls, once settle_until has passed.
+    """
+    pending = set(instance_ids)
+    rebooted = set()
+    while pending and time.time() < wait_timeout:
+        time.sleep(5)
+        settled = time.time() >= settle_until
+        reported = set()
+        for status in ec2.get_all_instance_status(instance_ids=list(pending), include_all_instances=True):
+            reported.add(status.id)
+            if (getattr(status, 'state_name', 'running') == 'running' and
+                    status.system_status.status == 'ok' and status.instance_status.status == 'ok'):
+                if settled or status.id in rebooted:
+                    pending.discard(status.id)
+            else:
+                rebooted.add(status.id)
+        # instances without a status are still coming back up
+        rebooted.update(pending - reported)
+
+    if pending:
+        module.fail_json(msg = "wait for instance status checks timeout on %s, instances not healthy: %s" % (
+            time.asctime(), ', '.join(sorted(pending))))
+
+
+def rolling_restart_batch(module, ec2, batch):
+    """
+    Reboots a batch of instances concurrently, then waits for their status
+    checks to pass before the next batch may start
+    Returns:
+        dictionary with the batch instance ID's and its timings in seconds
+    """
+    wait_timeout = int(module.params.get('wait_timeout'))
+    started = time.time()
+
+    def reboot(inst):
+        try:
+            inst.reboot()
+            return None
+        except EC2ResponseError as e:
+            return '{0}: {1}'.format(inst.id, e)
+
+    errors = [error for error in _parallel_map(reboot, batch, module.params.get('max_concurrency')) if error]
+    if errors:
+        module.fail_json(msg='Unable to change state for instances, error: {0}'.format('; '.join(errors)))
+    rebooted = time.time()
+    await_instance_status_ok(module, ec2, [inst.id for inst in batch], rebooted + wait_timeout,
+                             settle_until=rebooted + module.params.get('restart_settle_time'))
+    healthy = time.time()
+
+    return {'instance_ids': [inst.id for inst in batch],
+            'reboot_seconds': round(rebooted - started, 3),
+            'health_wait_seconds': round(healthy - rebooted, 3),
+            'total_seconds': round(healthy - started, 3),
+            }
+
+
+def select_fields(instance_dict_array, fields):
+    """
+    Returns copies of the instance dictionaries holding only fields,
+    or the dictionaries themselves if fields is empty
+    """
+    if not fields:
+        return instance_dict_array
+    return [dict((k, v) for (k, v) in iteritems(d) if k in fields) for d in instance_dict_array]
+
+
+def write_instance_records(module, path, **record_lists):
+    """
+    Streams instance dictionaries to path as newline delimited JSON, one
+    record per line, each labelled with the name of the list it came from
+    (for example instances or tagged_instances). The file is written under
+    a temporary name and renamed into place once complete.
+    Returns:
+        dictionary with the number of records written per list
+    """
+    counts = dict((name, 0) for name in record_lists)
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ec2-')
+        with os.fdopen(fd, 'w') as f:
+            for name in sorted(record_lists):
+                for record in record_lists[name]:
+                    line = dict(record)
+                    line['result'] = name
+                    f.write(json.dumps(line, sort_keys=True))
+                    f.write('\n')
+                    counts[name] += 1
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        module.fail_json(msg='Unable to write instance records to {0}, error: {1}'.format(path, e))
+    return counts
+
+
+PLAN_FORMAT_VERSION = 1
+
+
+def new_plan(state):
+    """
+    Returns an empty plan for the given module state. A plan records
+    what the module would do, computed from a single describe snapshot,
+    without performing any mutating call.
+    """
+    return {'version': PLAN_FORMAT_VERSION,
+            'id': uuid.uuid4().hex,
+            'state': state,
+            'created': time.time(),
+            'snapshot': [],
+            'launch': 0,
+            'terminate': [],
+            'start': [],
+            'stop': [],
+            'reboot': [],
+            'attributes': [],
+            }
+
+
+def plan_has_changes(plan):
+    return bool(plan['launch'] or plan['terminate'] or plan['start'] or
+                plan['stop'] or plan['reboot'] or plan['attributes'])
+
+
+def _plan_snapshot_entry(inst):
+    return {'id': inst.id, 'state': inst.state}
+
+
+def plan_enforce_count(module, ec2):
+    """
+    Computes the launches or terminations needed to reach exact_count
+    module: Ansible module object
+    ec2: authenticated ec2 connection object
+    Returns:
+        (plan, list of running boto instances matching count_tag)
+    """
+    exact_count = module.params.get('exact_count')
+    count_tag = module.params.get('count_tag')
+    zone = module.params.get('zone')
+
+    # fail here if the exact count was specified without filtering
+    # on a tag, as this may lead to a undesired removal of instances
+    if exact_count and count_tag is None:
+        module.fail_json(msg="you must use the 'count_tag' option with exact_count")
+
+    plan = new_plan('present')
+
+    if module.check_mode and module.params.get('plan_from_snapshot'):
+        # plan from the inventory saved by an earlier run, without any call
+        instances = []
+        try:
+            snapshot = InventorySnapshot.open(module.params['inventory_snapshot_path'])
+        except (IOError, OSError, ValueError) as e:
+            module.fail_json(msg='Unable to open inventory snapshot {0}, error: {1}'.format(
+                module.params['inventory_snapshot_path'], e))
+        # the snapshot only holds the instances its filters selected, so it
+        # can only answer for the same filters
+        if snapshot.source != snapshot_source(count_tag, 'running', zone, module.params.get('instance_filter')):
+            module.fail_json(msg='Inventory snapshot {0} was taken for other filters ({1}), '
+                                 'plan without plan_from_snapshot'.format(module.params['inventory_snapshot_path'],
+                                                                          json.dumps(snapshot.source, sort_keys=True)))
+        plan_max_age = module.params.get('plan_max_age')
+        if plan_max_age and time.time() - snapshot.created > plan_max_age:
+            module.fail_json(msg='Inventory snapshot {0} is older than plan_max_age ({1} seconds)'.format(
+                module.params['inventory_snapshot_path'], plan_max_age))
+        query = tags_to_query(count_tag) + [{'state': 'running'}]
+        if zone:
+            query.append({'zone': zone})
+        if module.params.get('instance_filter'):
+            query.append(module.params['instance_filter'])
+        running_ids = snapshot.ids_matching(query)
+        plan['snapshot'] = [{'id': inst_id, 'state': 'running'} for inst_id in running_ids]
+    else:
+        reservations, instances = find_running_instances_by_count_tag(module, ec2, count_tag, zone)
+        running_ids = [ x.id for x in instances ]
+        plan['snapshot'] = [_plan_snapshot_entry(inst) for inst in instances]
+
+    if len(running_ids) < exact_count:
+        plan['launch'] = exact_count - len(running_ids)
+    elif len(running_ids) > exact_count:
+        to_remove = len(running_ids) - exact_count
+        all_instance_ids = sorted(running_ids)
+        plan['terminate'] = all_instance_ids[0:to_remove]
+
+    return plan, instances
+
+
+def plan_create_instances(module, ec2):
+    """
+    Computes how many instances create_instances would launch, taking
+    instances already running under the client token (id) into account
+    """
+    id = module.params.get('id')
+    count = module.params.get('count')
+
+    plan = new_plan('present')
+    running_instances = []
+    if id != None:
+        filter_dict = {'client-token':id, 'instance-state-name' : 'running'}
+        for res in ec2.get_all_instances(None, filter_dict):
+            running_instances.extend(res.instances)
+
+    plan['snapshot'] = [_plan_snapshot_entry(inst) for inst in running_instances]
+    plan['launch'] = max(int(count) - len(running_instances), 0)
+    return plan
+
+
+def plan_terminate_instances(module, ec2, instance_ids):
+    """
+    Computes which of instance_ids terminate_instances would terminate
+    """
+    if not isinstance(instance_ids, list) or len(instance_ids) < 1:
+        module.fail_json(msg='instance_ids should be a list of instances, aborting')
+
+    plan = new_plan('absent')
+    for res in ec2.get_all_instances(instance_ids):
+        for inst in res.instances:
+            plan['snapshot'].append(_plan_snapshot_entry(inst))
+            if inst.state == 'running' or inst.state == 'stopped':
+                plan['terminate'].append(inst.id)
+    return plan
+
+
+def plan_instance_state(module, ec2, instance_ids, state, instance_tags):
+    """
+    Computes the start, stop or reboot actions and the attribute changes
+    startstop_instances or restart_instances would make. Attribute values
+    are read with get_attribute, which does not modify the instance.
+    state: Intended state ("running", "stopped" or "restarted")
+    """
+    source_dest_check = module.params.get('source_dest_check')
+    termination_protection = module.params.get('termination_protection')
+
+    if not isinstance(instance_ids, list) or len(instance_ids) < 1:
+        # Fail unless the user defined instance tags
+        if not instance_tags:
+            module.fail_json(msg='instance_ids should be a list of instances, aborting')
+
+    filters = {}
+    if instance_tags:
+        for key, value in instance_tags.items():
+            filters["tag:" + key] = value
+
+    plan = new_plan(state)
+    multi_eni_instance_ids = []
+    for res in filter_reservations(describe_instances(module, ec2, instance_ids, filters),
+                                   module.params.get('instance_filter')):
+        for inst in res.instances:
+            plan['snapshot'].append(_plan_snapshot_entry(inst))
+
+            try:
+                if inst.vpc_id is not None and inst.get_attribute('sourceDestCheck')['sourceDestCheck'] != source_dest_check:
+                    plan['attributes'].append({'id': inst.id, 'attribute': 'sourceDestCheck',
+                                               'value': source_dest_check})
+            except boto.exception.EC2ResponseError as exc:
+                # sourceDestCheck is defined per-interface on instances
+                # with more than one Elastic Network Interface
+                if exc.code == 'InvalidInstanceID':
+                    multi_eni_instance_ids.append(inst.id)
+                else:
+                    module.fail_json(msg='Failed to handle source_dest_check state for instance {0}, error: {1}'.format(inst.id, exc),
+                                     exception=traceback.format_exc(exc))
+
+            if (termination_protection is not None and
+                    inst.get_attribute('disableApiTermination')['disableApiTermination'] != termination_protection):
+                plan['attributes'].append({'id': inst.id, 'attribute': 'disableApiTermination',
+                                           'value': termination_protection})
+
+            if state == 'restarted':
+                plan['reboot'].append(inst.id)
+            elif inst.state != state:
+                if state == 'running':
+                    plan['start'].append(inst.id)
+                else:
+                    plan['stop'].append(inst.id)
+
+    for interface in find_drifted_interfaces(ec2, multi_eni_instance_ids, source_dest_check):
+        plan['attributes'].append({'id': interface.attachment.instance_id, 'interface_id': interface.id,
+                                   'attribute': 'sourceDestCheck', 'value': source_dest_check})
+
+    return plan
+
+
+def build_plan(module, ec2):
+    """
+    Computes the plan for the requested module state without changing anything
+    """
+    state = module.params['state']
+    instance_ids = module.params.get('instance_ids')
+    instance_tags = module.params.get('instance_tags')
+
+    if state == 'absent':
+        if not instance_ids:
+            module.fail_json(msg='instance_ids list is required for absent state')
+        return plan_terminate_instances(module, ec2, instance_ids)
+    elif state in ('running', 'stopped', 'restarted'):
+        if not (isinstance(instance_ids, list) or isinstance(instance_tags, dict)):
+            module.fail_json(msg='running list needs to be a list of instances or set of tags to run: %s' % instance_ids)
+        return plan_instance_state(module, ec2, instance_ids, state, instance_tags)
+    else:
+        if not module.params.get('image'):
+            module.fail_json(msg='image parameter is required for new instance')
+        if module.params.get('exact_count') is None:
+            return plan_create_instances(module, ec2)
+        return plan_enforce_count(module, ec2)[0]
+
+
+def _plan_actions(plan):
+    return (plan['state'], plan['launch'], sorted(plan['terminate']), sorted(plan['start']),
+            sorted(plan['stop']), sorted(plan['reboot']),
+            sorted(json.dumps(change, sort_keys=True) for change in plan['attributes']))
+
+
+def plan_diff(plan):
+    """
+    Returns an Ansible diff of the instance states before and after the plan
+    """
+    before = dict((entry['id'], entry['state']) for entry in plan['snapshot'])
+    after = dict(before)
+    for inst_id in plan['terminate']:
+        after[inst_id] = 'terminated'
+    for inst_id in plan['start']:
+        after[inst_id] = 'running'
+    for inst_id in plan['stop']:
+        after[inst_id] = 'stopped'
+    for i in range(plan['launch']):
+        after['(new instance %d)' % (i + 1)] = 'running'
+    return {'before': {'instances': before}, 'after': {'instances': after}}
+
+
+def save_plan(module, plan, path):
+    """
+    Writes the plan as JSON to path, replacing any existing file atomically
+    """
+    try:
+        _write_json_atomic(path, plan)
+    except (IOError, OSError) as e:
+        module.fail_json(msg='Unable to save plan to {0}, error: {1}'.format(path, e))
+
+
+def load_plan(module, path):
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        module.fail_json(msg='Unable to load plan from {0}, error: {1}'.format(path, e))
+    if plan.get('version') != PLAN_FORMAT_VERSION:
+        module.fail_json(msg='Unsupported plan version {0} in {1}'.format(plan.get('version'), path))
+    return plan
+
+
+def apply_plan(module, ec2, vpc, plan):
+    """
+    Performs the actions recorded in a plan saved by a check mode run
+    module: Ansible module object
+    ec2: authenticated ec2 connection object
+    plan: plan dictionary as returned by build_plan
+    The plan is only applied while it is younger than plan_max_age and a
+    fresh plan computed from a new describe calls for the same actions, so
+    a plan that was already applied, or that the instances have drifted
+    from, fails instead of acting twice. Instances launched by the plan use
+    a client token derived from it unless id is set. With restart_batch_size
+    set, reboots are rolled out in batches as restart_instances does.
+    Returns:
+        (changed, instance_dict_array, instance_ids, restart batch timings)
+    """
+    plan_max_age = module.params.get('plan_max_age')
+    if plan_max_age and time.time() - plan['created'] > plan_max_age:
+        module.fail_json(msg='Plan is older than plan_max_age ({0} seconds), compute a new one'.format(plan_max_age))
+
+    if module.params.get('id') is None and plan.get('id'):
+        module.params['id'] = 'plan-%s' % plan['id']
+
+    current = build_plan(module, ec2)
+    if _plan_actions(current) != _plan_actions(plan):
+        module.fail_json(msg='Plan no longer matches the current instances, compute a new one',
+                         plan=plan, current_plan=current)
+
+    restart_batch_size = module.params.get('restart_batch_size')
+    changed = False
+    instance_dict_array = []
+    instance_ids = []
+
+    try:
+        for change in plan['attributes']:
+            if 'interface_id' in change:
+                ec2.modify_network_interface_attribute(change['interface_id'], change['attribute'], change['value'])
+            else:
+                ec2.modify_instance_attribute(change['id'], change['attribute'], change['value'])
+            changed = True
+
+        if plan['start']:
+            ec2.start_instances(plan['start'])
+        if plan['stop']:
+            ec2.stop_instances(plan['stop'])
+        if plan['reboot'] and not restart_batch_size:
+            ec2.reboot_instances(plan['reboot'])
+    except EC2ResponseError as e:
+        module.fail_json(msg='Unable to apply plan, error: {0}'.format(e))
+
+    batches = []
+    if plan['reboot'] and restart_batch_size:
+        to_reboot = []
+        for res in ec2.get_all_instances(plan['reboot']):
+            to_reboot.extend(res.instances)
+        for start in range(0, len(to_reboot), restart_batch_size):
+            batches.append(rolling_restart_batch(module, ec2, to_reboot[start:start + restart_batch_size]))
+
+    touched_ids = plan['start'] + plan['stop'] + plan['reboot']
+    if touched_ids:
+        changed = True
+        for res in ec2.get_all_instances(touched_ids):
+            for inst in res.instances:
+                instance_dict_array.append(get_instance_info(inst))
+        instance_ids.extend(touched_ids)
+
+    if plan['terminate']:
+        (terminated, terminated_dict_array, terminated_ids) = terminate_instances(module, ec2, plan['terminate'])
+        changed = changed or terminated
+        instance_dict_array.extend(terminated_dict_array)
+        instance_ids.extend(terminated_ids)
+
+    if plan['launch'] > 0:
+        if not module.params.get('image'):
+            module.fail_json(msg='image parameter is required for new instance')
+        (created_dict_array, created_ids, created) = create_instances(module, ec2, vpc, override_count=plan['launch'])
+        changed = changed or created
+        instance_dict_array.extend(created_dict_array)
+        instance_ids.extend(created_ids)
+
+    return (changed, instance_dict_array, instance_ids, batches)
 
 
 def main():
@@ -929,7 +3028,37 @@ def main():
             volumes = dict(type='list'),
             ebs_optimized = dict(type='bool', default=False),
             tenancy = dict(default='default'),
-            network_interfaces = dict(type='list', aliases=['network_interface'])
+            network_interfaces = dict(type='list', aliases=['network_interface']),
+            plan_path = dict(type='path'),
+            apply_plan = dict(type='path'),
+            plan_max_age = dict(type='int', default=3600),
+            launch_journal = dict(type='path'),
+            zones = dict(type='list'),
+            instance_types = dict(type='list'),
+            launch_batch_size = dict(type='int'),
+            max_concurrency = dict(type='int', default=4),
+            spot_oversubscription = dict(type='float', default=1.0),
+            spot_fallback_on_demand = dict(type='bool', default=False),
+            instance_filter = dict(type='raw'),
+            restart_batch_size = dict(type='int'),
+            restart_settle_time = dict(type='int', default=60),
+            output_path = dict(type='path'),
+            output_fields = dict(type='list'),
+            capability_index = dict(type='path'),
+            reconcile_interval = dict(type='int'),
+            reconcile_max_runs = dict(type='int'),
+            reconcile_trigger_path = dict(type='path'),
+            metrics_path = dict(type='path'),
+            user_data_parts = dict(type='list'),
+            user_data_format = dict(default='raw', choices=['raw', 'gzip', 'multipart-gzip']),
+            user_data_cache_dir = dict(type='path'),
+            describe_shard_by = dict(choices=['availability-zone', 'instance-state-name', 'instance-type']),
+            describe_shards = dict(type='list'),
+            inventory_snapshot_path = dict(type='path'),
+            plan_from_snapshot = dict(type='bool', default=False),
+            slow_call_log = dict(type='path'),
+            slow_call_threshold = dict(type='float', default=1.0),
+            call_profile_path = dict(type='path'),
         )
     )
 
@@ -944,7 +3073,13 @@ def main():
                                 ['network_interfaces', 'group_id'],
                                 ['network_interfaces', 'private_ip'],
                                 ['network_interfaces', 'vpc_subnet_id'],
+                                ['plan_path', 'apply_plan'],
+                                ['reconcile_interval', 'apply_plan'],
                              ],
+        required_if = [
+                                ['plan_from_snapshot', True, ['inventory_snapshot_path']],
+                      ],
+        supports_check_mode=True,
     )
 
     if not HAS_BOTO:
@@ -962,11 +3097,40 @@ def main():
     else:
         vpc = None
 
+    if module.params.get('slow_call_log') or module.params.get('call_profile_path'):
+        enable_call_profiling(module, ec2, vpc)
+
     tagged_instances = []
+    extra_results = dict()
 
     state = module.params['state']
 
-    if state == 'absent':
+    for name in ('launch_batch_size', 'max_concurrency', 'restart_batch_size'):
+        if module.params.get(name) is not None and module.params[name] < 1:
+            module.fail_json(msg='{0} must be at least 1'.format(name))
+
+    if module.params.get('instance_filter') is not None:
+        try:
+            check_query(module.params['instance_filter'])
+        except ValueError as e:
+            module.fail_json(msg='Invalid instance_filter: {0}'.format(e))
+
+    if state == 'present':
+        validate_launch_request(module, load_capability_index(module, module.params.get('capability_index')))
+
+    if module.check_mode:
+        plan = build_plan(module, ec2)
+        if module.params.get('plan_path'):
+            save_plan(module, plan, module.params['plan_path'])
+        module.exit_json(changed=plan_has_changes(plan), plan=plan, diff=plan_diff(plan))
+
+    if module.params.get('apply_plan'):
+        plan = load_plan(module, module.params['apply_plan'])
+        (changed, instance_dict_array, new_instance_ids, restart_batches) = apply_plan(module, ec2, vpc, plan)
+        if restart_batches:
+            extra_results['restart_batches'] = restart_batches
+
+    elif state == 'absent':
         instance_ids = module.params['instance_ids']
         if not instance_ids:
             module.fail_json(msg='instance_ids list is required for absent state')
@@ -987,7 +3151,9 @@ def main():
         if not (isinstance(instance_ids, list) or isinstance(instance_tags, dict)):
             module.fail_json(msg='running list needs to be a list of instances or set of tags to run: %s' % instance_ids)
 
-        (changed, instance_dict_array, new_instance_ids) = restart_instances(module, ec2, instance_ids, state, instance_tags)
+        (changed, instance_dict_array, new_instance_ids, restart_batches) = restart_instances(module, ec2, instance_ids, state, instance_tags)
+        if restart_batches:
+            extra_results['restart_batches'] = restart_batches
 
     elif state == 'present':
         # Changed is always set to true when provisioning new instances
@@ -996,10 +3162,27 @@ def main():
 
         if module.params.get('exact_count') is None:
             (instance_dict_array, new_instance_ids, changed) = create_instances(module, ec2, vpc)
+        elif module.params.get('reconcile_interval'):
+            (tagged_instances, instance_dict_array, new_instance_ids, changed, metrics) = reconcile_daemon(module, ec2, vpc)
+            extra_results['reconcile_metrics'] = metrics
         else:
             (tagged_instances, instance_dict_array, new_instance_ids, changed) = enforce_count(module, ec2, vpc)
 
-    module.exit_json(changed=changed, instance_ids=new_instance_ids, instances=instance_dict_array, tagged_instances=tagged_instances)
+    output_fields = module.params.get('output_fields')
+    instance_dict_array = select_fields(instance_dict_array, output_fields)
+    tagged_instances = select_fields(tagged_instances, output_fields)
+
+    # keep the module result small for large instance sets by streaming
+    # the instance records to a local file instead
+    output_path = module.params.get('output_path')
+    if output_path:
+        counts = write_instance_records(module, output_path, instances=instance_dict_array,
+                                        tagged_instances=tagged_instances)
+        module.exit_json(changed=changed, output_path=output_path, instance_count=counts['instances'],
+                         tagged_instance_count=counts['tagged_instances'], **extra_results)
+
+    module.exit_json(changed=changed, instance_ids=new_instance_ids, instances=instance_dict_array, tagged_instances=tagged_instances,
+                     **extra_results)
 
 # import module snippets
 from ansible.module_utils.basic import *
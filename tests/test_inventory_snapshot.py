@@ -0,0 +1,91 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ansible.module_utils.ec2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import ec2  # noqa: E402
+
+
+class FakeInstance(object):
+    def __init__(self, id, state='running', placement='us-west-2a', instance_type='t2.micro',
+                 launch_time='2016-08-01T12:00:00.000Z', tags=None):
+        self.id = id
+        self.state = state
+        self.placement = placement
+        self.instance_type = instance_type
+        self.launch_time = launch_time
+        self.tags = tags or {}
+
+
+def make_instances():
+    return [
+        FakeInstance('i-0123456789abcdef0', tags={'role': 'web', 'env': 'prod'}),
+        FakeInstance('i-1', state='stopped', placement='us-west-2b', tags={'role': 'db'}),
+        FakeInstance('i-2', instance_type='m5.large', launch_time='2017-01-01T00:00:00.000Z',
+                     tags={'role': u'w\xe9b'}),
+        FakeInstance('i-3', state='pending', launch_time=None),
+    ]
+
+
+QUERIES = [
+    None,
+    {'state': 'running'},
+    {'zone': 'us-west-2b'},
+    {'instance_type': {'prefix': 'm5'}},
+    {'tag:role': {'in': ['web', 'db']}},
+    {'tag:env': {'exists': False}},
+    {'launch_time': {'after': '2016-12-31T00:00:00.000Z'}},
+    {'or': [{'state': 'stopped'}, {'not': {'tag:role': {'regex': '^w'}}}]},
+]
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('inventory.snap'))
+    source = ec2.snapshot_source({'role': 'web'}, 'running', None, None)
+    snapshot = ec2.InventorySnapshot.from_instances(make_instances())
+    snapshot.write(path, source=source)
+
+    opened = ec2.InventorySnapshot.open(path)
+
+    assert list(opened.ids) == snapshot.ids
+    assert list(opened.state_codes) == list(snapshot.state_codes)
+    assert list(opened.launch_times) == list(snapshot.launch_times)
+    assert opened.created == snapshot.created
+    assert opened.source == source
+    assert sorted(opened.tags) == sorted(snapshot.tags)
+    for query in QUERIES:
+        assert opened.ids_matching(query) == snapshot.ids_matching(query), query
+
+
+def test_round_trip_wide_columns(tmpdir):
+    # more than 255 distinct values are stored with 4 byte codes
+    path = str(tmpdir.join('inventory.snap'))
+    instances = [FakeInstance('i-%d' % i, tags={'name': 'host-%d' % i}) for i in range(300)]
+    ec2.InventorySnapshot.from_instances(instances).write(path)
+
+    opened = ec2.InventorySnapshot.open(path)
+
+    assert opened.source is None
+    assert opened.ids_matching({'tag:name': 'host-299'}) == ['i-299']
+    assert len(opened.ids_matching({'tag:name': {'prefix': 'host-1'}})) == 111
+
+
+def test_round_trip_empty(tmpdir):
+    path = str(tmpdir.join('inventory.snap'))
+    ec2.InventorySnapshot.from_instances([]).write(path)
+
+    opened = ec2.InventorySnapshot.open(path)
+
+    assert len(opened) == 0
+    assert opened.ids_matching({'state': 'running'}) == []
+
+
+def test_open_rejects_other_files(tmpdir):
+    path = tmpdir.join('inventory.snap')
+    path.write_binary(b'not a snapshot, just some bytes of another file')
+
+    with pytest.raises(ValueError):
+        ec2.InventorySnapshot.open(str(path))
@@ -0,0 +1,291 @@
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('ansible.module_utils.ec2')
+pytest.importorskip('boto')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import ec2  # noqa: E402
+from boto.exception import EC2ResponseError  # noqa: E402
+
+
+class FailJson(Exception):
+    pass
+
+
+class FakeModule(object):
+    def __init__(self, **params):
+        self.params = dict(count=1, image='ami-123456', instance_type='t2.micro', tenancy='default',
+                           spot_type='one-time', monitoring=False, wait=False, wait_timeout=300,
+                           spot_wait_timeout=600, source_dest_check=True, max_concurrency=4,
+                           plan_max_age=3600, state='present')
+        self.params.update(params)
+        self.check_mode = False
+        self.warnings = []
+
+    def fail_json(self, **kwargs):
+        raise FailJson(kwargs)
+
+    def warn(self, warning):
+        self.warnings.append(warning)
+
+    def boolean(self, value):
+        return value
+
+
+class FakeInstance(object):
+    def __init__(self, id, client_token=None, placement='us-west-2a', instance_type='t2.micro', tags=None):
+        self.id = id
+        self.client_token = client_token
+        self.state = 'running'
+        self.state_code = 16
+        self.placement = placement
+        self.instance_type = instance_type
+        self.tags = dict(tags or {})
+        self.launch_time = '2016-08-01T12:00:00.000Z'
+        self.groups = []
+        for name in ('ami_launch_index', 'private_ip_address', 'private_dns_name', 'ip_address',
+                     'dns_name', 'public_dns_name', 'architecture', 'image_id', 'key_name', 'kernel',
+                     'ramdisk', 'root_device_type', 'root_device_name', 'hypervisor'):
+            setattr(self, name, None)
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+class FakeConnection(object):
+    """
+    Keeps instances in memory and answers the calls create_instances makes
+    """
+
+    def __init__(self, instances=None, failing_zones=None):
+        self.instances = list(instances or [])
+        self.failing_zones = failing_zones or {}
+        self.launches = []
+        self.tagged = []
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        matching = []
+        for inst in self.instances:
+            if instance_ids and inst.id not in instance_ids:
+                continue
+            if not all(self._matches(inst, name, value) for name, value in (filters or {}).items()):
+                continue
+            matching.append(inst)
+        return [FakeReservation(matching)] if matching else []
+
+    def _matches(self, inst, name, value):
+        if name == 'client-token':
+            return inst.client_token in _as_list(value)
+        if name == 'instance-state-name':
+            return inst.state in _as_list(value)
+        if name == 'availability-zone':
+            return inst.placement == value
+        if name.startswith('tag:'):
+            return inst.tags.get(name[4:]) == value
+        raise AssertionError('unexpected filter %s' % name)
+
+    def run_instances(self, **params):
+        self.launches.append(params)
+        zone = params.get('placement')
+        if zone in self.failing_zones:
+            raise EC2ResponseError(400, 'Bad Request', '<Response><Errors><Error><Code>%s</Code>'
+                                   '<Message></Message></Error></Errors></Response>' % self.failing_zones[zone])
+        launched = []
+        for i in range(params['max_count']):
+            inst = FakeInstance('i-%d' % (len(self.instances) + 1), client_token=params.get('client_token'),
+                                placement=zone or 'us-west-2a', instance_type=params.get('instance_type'))
+            self.instances.append(inst)
+            launched.append(inst)
+        return FakeReservation(launched)
+
+    def create_tags(self, instance_ids, tags):
+        self.tagged.append((list(instance_ids), tags))
+        for inst in self.instances:
+            if inst.id in instance_ids:
+                inst.tags.update(tags)
+
+
+def write_journal(path, **fields):
+    journal = {'version': ec2.LAUNCH_JOURNAL_VERSION,
+               'client_token': 'journal-token',
+               'user_token': False,
+               'steps': [],
+               'client_tokens': [],
+               'spot_request_ids': [],
+               'instance_ids': [],
+               'instances': [],
+               }
+    journal.update(fields)
+    with open(path, 'w') as f:
+        json.dump(journal, f)
+
+
+def read_journal(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_token_is_journaled_before_launching(tmpdir):
+    path = str(tmpdir.join('journal.json'))
+
+    class Interrupted(Exception):
+        pass
+
+    class InterruptedConnection(FakeConnection):
+        def run_instances(self, **params):
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        ec2.create_instances(FakeModule(count=2, launch_journal=path), InterruptedConnection(), None)
+
+    journal = read_journal(path)
+    assert journal['steps'] == ['requested']
+    assert journal['client_tokens'] == [journal['client_token']]
+
+
+def test_resume_after_requested_launches_only_the_remainder(tmpdir):
+    path = str(tmpdir.join('journal.json'))
+    write_journal(path, steps=['requested'], client_tokens=['journal-token'])
+    conn = FakeConnection([FakeInstance('i-a', client_token='journal-token'),
+                           FakeInstance('i-b', client_token='journal-token'),
+                           FakeInstance('i-other', client_token='other-token')])
+
+    (instances, instance_ids, changed) = ec2.create_instances(
+        FakeModule(count=3, launch_journal=path, instance_tags={'role': 'web'}), conn, None)
+
+    assert changed
+    assert len(conn.launches) == 1
+    assert conn.launches[0]['max_count'] == 1
+    # EC2 rejects a reused token whose request differs
+    assert conn.launches[0]['client_token'] == 'journal-token-r1'
+    assert sorted(instance_ids) == ['i-4', 'i-a', 'i-b']
+    assert sorted(conn.tagged[0][0]) == ['i-4', 'i-a', 'i-b']
+    journal = read_journal(path)
+    assert 'complete' in journal['steps']
+    assert journal['client_tokens'] == ['journal-token', 'journal-token-r1']
+
+
+def test_resume_after_requested_with_everything_launched(tmpdir):
+    path = str(tmpdir.join('journal.json'))
+    write_journal(path, steps=['requested'], client_tokens=['journal-token'])
+    conn = FakeConnection([FakeInstance('i-a', client_token='journal-token'),
+                           FakeInstance('i-b', client_token='journal-token')])
+
+    (instances, instance_ids, changed) = ec2.create_instances(FakeModule(count=2, launch_journal=path), conn, None)
+
+    assert changed
+    assert conn.launches == []
+    assert sorted(instance_ids) == ['i-a', 'i-b']
+
+
+def test_resume_after_launched_does_not_launch_again(tmpdir):
+    path = str(tmpdir.join('journal.json'))
+    write_journal(path, steps=['requested', 'launched', 'running'], client_tokens=['journal-token'],
+                  instance_ids=['i-a', 'i-b'])
+    conn = FakeConnection([FakeInstance('i-a', client_token='journal-token'),
+                           FakeInstance('i-b', client_token='journal-token')])
+
+    (instances, instance_ids, changed) = ec2.create_instances(
+        FakeModule(count=2, launch_journal=path, instance_tags={'role': 'web'}), conn, None)
+
+    assert changed
+    assert conn.launches == []
+    assert conn.tagged == [(['i-a', 'i-b'], {'role': 'web'})]
+    assert sorted(instance_ids) == ['i-a', 'i-b']
+    assert read_journal(path)['steps'][-1] == 'complete'
+
+
+def test_completed_generated_journal_starts_a_new_launch(tmpdir):
+    path = str(tmpdir.join('journal.json'))
+    write_journal(path, steps=['requested', 'launched', 'complete'], instance_ids=['i-a'])
+
+    journal = ec2.load_launch_journal(FakeModule(), path, None)
+
+    assert journal['steps'] == []
+    assert journal['client_token'] != 'journal-token'
+
+
+def test_completed_journal_with_user_token_is_reused(tmpdir):
+    path = str(tmpdir.join('journal.json'))
+    write_journal(path, client_token='my-token', user_token=True, steps=['requested', 'launched', 'complete'],
+                  instance_ids=['i-a'])
+    conn = FakeConnection()
+
+    (instances, instance_ids, changed) = ec2.create_instances(
+        FakeModule(id='my-token', launch_journal=path), conn, None)
+
+    assert not changed
+    assert conn.launches == []
+    assert instance_ids == ['i-a']
+
+
+def test_split_launch_reports_instances_of_sibling_requests():
+    module = FakeModule(launch_batch_size=None, max_concurrency=2)
+    conn = FakeConnection(failing_zones={'us-west-2b': 'UnauthorizedOperation'})
+
+    with pytest.raises(FailJson) as excinfo:
+        ec2.split_launch(module, conn, {'client_token': 'token'}, 2,
+                         [('us-west-2a', 't2.micro'), ('us-west-2b', 't2.micro')])
+
+    assert excinfo.value.args[0]['instance_ids'] == ['i-1']
+
+
+def test_split_launch_moves_shortfall_to_next_pool():
+    module = FakeModule(launch_batch_size=None, max_concurrency=2)
+    conn = FakeConnection(failing_zones={'us-west-2b': 'InsufficientInstanceCapacity'})
+
+    launched = ec2.split_launch(module, conn, {'client_token': 'token'}, 4,
+                                [('us-west-2a', 't2.micro'), ('us-west-2b', 't2.micro')])
+
+    assert len(launched) == 4
+    assert all(inst.placement == 'us-west-2a' for inst in launched)
+
+
+def test_apply_plan_twice_is_rejected():
+    params = dict(exact_count=3, count_tag='{"role": "web"}', count=None)
+    conn = FakeConnection([FakeInstance('i-a', tags={'role': 'web'})])
+
+    plan = ec2.build_plan(FakeModule(**params), conn)
+    assert plan['launch'] == 2
+
+    # instances launched by the plan carry the count tag
+    original_run_instances = conn.run_instances
+
+    def run_instances(**run_params):
+        reservation = original_run_instances(**run_params)
+        for inst in reservation.instances:
+            inst.tags['role'] = 'web'
+        return reservation
+    conn.run_instances = run_instances
+
+    (changed, instances, instance_ids, batches) = ec2.apply_plan(FakeModule(**params), conn, None, plan)
+    assert changed
+    assert len(conn.launches) == 1
+    assert conn.launches[0]['client_token'] == 'plan-%s' % plan['id']
+
+    with pytest.raises(FailJson) as excinfo:
+        ec2.apply_plan(FakeModule(**params), conn, None, plan)
+    assert 'no longer matches' in excinfo.value.args[0]['msg']
+    assert len(conn.launches) == 1
+
+
+def test_apply_plan_rejects_old_plans():
+    params = dict(exact_count=1, count_tag='{"role": "web"}', count=None)
+    conn = FakeConnection()
+    plan = ec2.build_plan(FakeModule(**params), conn)
+    plan['created'] -= 7200
+
+    with pytest.raises(FailJson) as excinfo:
+        ec2.apply_plan(FakeModule(**params), conn, None, plan)
+    assert 'plan_max_age' in excinfo.value.args[0]['msg']
+    assert conn.launches == []